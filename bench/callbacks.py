@@ -0,0 +1,92 @@
+"""Бенчмарк разбора callback_data: цепочка фильтров F.data против таблицы кодов.
+
+Запуск: python bench/callbacks.py [повторов]
+Бот импортируется с тестовым токеном во временной папке — сеть и боевая БД не нужны.
+"""
+import asyncio
+import sys
+import time
+
+from aiogram import F, Router
+from aiogram.types import CallbackQuery
+
+from common import bot
+
+# Фильтры в том порядке, в котором они были зарегистрированы до перехода на коды
+OLD_FILTERS = [
+    F.data == "catalog", F.data.startswith("cat_"), F.data.startswith("page_"), F.data.startswith("kp:"),
+    F.data == "pageinfo", F.data.startswith("product_"), F.data.startswith("buy_"),
+    F.data == "admin_products", F.data.startswith("admincat_"), F.data.startswith("del_"),
+    F.data == "admin_back", F.data == "admin_stats", F.data == "admin_orders",
+    F.data == "order_link", F.data == "support", F.data == "back_main",
+]
+
+CATEGORY = '👟 Обувь'
+CURSOR = (23, '2024-05-01 12:00:00')
+
+# (старая callback_data, новая) для типичных кнопок
+SAMPLES = [
+    ("catalog", "c"),
+    (f"cat_{CATEGORY}", bot.callbacks.pack("k", CATEGORY)),
+    (f"page_{CATEGORY}_12", bot.callbacks.pack("g", CATEGORY, 12)),
+    ("product_123456", bot.callbacks.pack("p", 123456)),
+    ("buy_123456", bot.callbacks.pack("b", 123456)),
+    (f"admincat_{CATEGORY}", bot.callbacks.pack("ac", CATEGORY)),
+    ("del_123456", bot.callbacks.pack("ad", 123456)),
+    ("back_main", "m"),
+]
+
+def callback(data):
+    return CallbackQuery.model_validate({
+        'id': '1', 'from': {'id': 5, 'is_bot': False, 'first_name': 'U'},
+        'chat_instance': '1', 'data': data,
+    })
+
+async def noop(callback: CallbackQuery):
+    pass
+
+async def dispatch(callback: CallbackQuery):
+    bot.callbacks.unpack(callback.data)
+
+def old_router():
+    router = Router()
+    for flt in OLD_FILTERS:
+        router.callback_query.register(noop, flt)
+    return router
+
+def new_router():
+    router = Router()
+    router.callback_query.register(dispatch)
+    return router
+
+async def per_call(router, events, rounds):
+    observer = router.callback_query
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for event in events:
+            await observer.trigger(event)
+    return (time.perf_counter() - start) / (rounds * len(events))
+
+async def main(rounds):
+    old_events = [callback(old) for old, _ in SAMPLES]
+    new_events = [callback(new) for _, new in SAMPLES]
+
+    print(f"{'кнопка':<24}{'было, байт':>12}{'стало, байт':>13}")
+    for old, new in SAMPLES:
+        print(f"{old[:23]:<24}{len(old.encode()):>12}{len(new.encode()):>13}")
+
+    old_time = await per_call(old_router(), old_events, rounds)
+    new_time = await per_call(new_router(), new_events, rounds)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for _, new in SAMPLES:
+            bot.callbacks.unpack(new)
+    unpack_time = (time.perf_counter() - start) / (rounds * len(SAMPLES))
+
+    print(f"\nфильтры F.data:       {old_time * 1e6:7.2f} мкс на callback")
+    print(f"таблица кодов:        {new_time * 1e6:7.2f} мкс на callback")
+    print(f"  из них unpack:      {unpack_time * 1e6:7.2f} мкс")
+    print(f"ускорение:            {old_time / new_time:7.1f}x")
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
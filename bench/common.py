@@ -0,0 +1,16 @@
+"""Общее для бенчмарков: bot.py импортируется с тестовым токеном во временной папке.
+
+Сеть и боевая БД не нужны: всё, что бот пишет на диск, остаётся во временной папке.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH')
+os.environ.setdefault('ADMIN_ID', '1')
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp())
+
+import bot  # noqa: E402
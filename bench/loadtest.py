@@ -0,0 +1,458 @@
+"""Нагрузочный тест: бот против локальной заглушки Bot API.
+
+Запуск: python bench/loadtest.py [--users 500] [--duration 60] [--products 20000] [--json итог.json]
+
+Что происходит:
+1. Во временной папке собирается синтетический экспорт канала (--products постов,
+   генератор с --seed) и загружается в БД бота штатным `python bot.py import`.
+2. Поднимается заглушка Bot API на aiohttp: отвечает на getMe/sendMessage/
+   editMessageText/... и раздаёт апдейты через getUpdates.
+3. bot.py запускается отдельным процессом с TELEGRAM_API_URL на заглушку —
+   как в бою, через polling. WORKERS, CATALOG_MODE и прочие настройки бота
+   берутся из окружения: WORKERS=4 python bench/loadtest.py
+4. --users пользователей ходят по сценариям (каталог → категория → страницы →
+   товар, заказ из каталога, заказ по ссылке через FSM), а отдельная задача
+   публикует посты в канал (--posts в секунду) для автопарсера.
+
+Задержка шага — от постановки апдейта в getUpdates до первого ответа бота этому
+пользователю (send*/edit*/answerCallbackQuery). Задержка поста — до появления
+товара в БД (включает окно пачки INGEST_WINDOW). Генератор нагрузки и заглушка
+живут в одном процессе: на тысячах пользователей смотрите, что он не упёрся в CPU
+раньше бота (в итоге печатается его собственная загрузка).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT = os.path.join(ROOT, 'bot.py')
+TOKEN = '123456:LOADTESTLOADTESTLOADTESTLOADTESTLOAD'
+ADMIN_ID = 1
+CHANNEL = 'poizonlab2'
+CHANNEL_CHAT = {'id': -1001234567890, 'type': 'channel', 'username': CHANNEL, 'title': 'POIZON LAB'}
+FIRST_USER = 100000
+REPLY_TIMEOUT = 15
+
+# Названия подобраны под ключевые слова CATEGORIES, чтобы товары разошлись по категориям
+NAMES = ['Кроссовки Nike Dunk Low', 'Кроссовки New Balance 550', 'Ботинки Timberland', 'Сланцы Adidas',
+         'Пуховик The North Face', 'Куртка Stone Island', 'Худи Stussy', 'Бомбер Alpha',
+         'Футболка Supreme', 'Джинсы Levis 501', 'Шорты Nike', 'Рубашка Ralph Lauren',
+         'Сумка Prada', 'Рюкзак Fjallraven', 'Кошелек Gucci', 'Часы Casio', 'Кепка New Era',
+         'Очки Ray-Ban', 'Крем La Mer', 'Духи Tom Ford', 'Подарочная карта']
+SIZES = ['40-45', 'S-XL', 'One size', '36-41', 'XS-L']
+
+# ===== СИНТЕТИЧЕСКИЙ КАТАЛОГ =====
+def caption(rng, number):
+    return (f"{rng.choice(NAMES)} арт. {number}\n"
+            f"Цена: {rng.randrange(1500, 90000, 10)}₽\n"
+            f"Размеры: {rng.choice(SIZES)}")
+
+def write_export(path, products, seed):
+    """result.json в формате экспорта Telegram Desktop: products постов с фото"""
+    rng = random.Random(seed)
+    start = time.time() - products * 60
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"name": "POIZON LAB", "type": "public_channel", "id": 1234567890, "messages": [\n')
+        for i in range(1, products + 1):
+            message = {'id': i, 'type': 'message', 'photo': f'photos/photo_{i}.jpg',
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start + i * 60)),
+                       'text': caption(rng, i)}
+            f.write((',\n' if i > 1 else '') + json.dumps(message, ensure_ascii=False))
+        f.write('\n]}\n')
+
+# ===== ЗАГЛУШКА BOT API =====
+class FakeBotApi:
+    """Минимальный Bot API: апдейты для getUpdates и «ответы» бота пользователям.
+
+    Каждый send*/edit*/answerCallbackQuery с chat_id пользователя будит того,
+    кто ждёт ответа в expect(); клавиатура ответа передаётся сценарию.
+    """
+
+    SCREENS = {'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageMedia', 'editMessageCaption'}
+
+    def __init__(self):
+        self.pending = deque()
+        self.arrived = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000000)
+        self.waiters = {}
+        self.callbacks = {}  # id callback_query → чат
+        self.calls = {}
+
+    # --- апдейты ---
+    def push(self, update):
+        update['update_id'] = next(self.update_ids)
+        self.pending.append(update)
+        self.arrived.set()
+
+    def expect(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = future
+        return future
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        while self.pending and self.pending[0]['update_id'] < offset:
+            self.pending.popleft()
+        self.ready.set()
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.pending, limit))
+
+    # --- ответы бота ---
+    def message(self, method, params):
+        chat_id = int(params['chat_id'])
+        if method.startswith('send'):
+            message_id = next(self.message_ids)
+        else:
+            message_id = int(params.get('message_id') or 0)
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'}}
+        media = json.loads(params['media']) if 'media' in params else None
+        if method == 'sendPhoto' or media:
+            message['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+            message['caption'] = params.get('caption') or (media or {}).get('caption', '')
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+    def reply(self, chat_id, method, params, message=None):
+        future = self.waiters.pop(chat_id, None)
+        if future and not future.done():
+            markup = json.loads(params['reply_markup']) if params.get('reply_markup') else None
+            buttons = [button for row in (markup or {}).get('inline_keyboard', []) for button in row]
+            future.set_result((method, message, buttons))
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            result = await self.get_updates(params)
+        elif method == 'getMe':
+            result = {'id': 42, 'is_bot': True, 'first_name': 'Load', 'username': 'loadtest_bot'}
+        elif method == 'getChat':
+            result = {'id': int(params['chat_id']), 'type': 'private', 'username': 'admin',
+                      'accent_color_id': 0, 'max_reaction_count': 11}
+        elif method in self.SCREENS or method.startswith('send'):
+            result = self.message(method, params)
+            self.reply(result['chat']['id'], method, params, result)
+        elif method == 'answerCallbackQuery':
+            result = True
+            chat_id = self.callbacks.pop(params.get('callback_query_id'), None)
+            if chat_id is not None:
+                self.reply(chat_id, method, params)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}"
+
+# ===== ПОЛЬЗОВАТЕЛИ =====
+class Stats:
+    def __init__(self):
+        self.latency = {}   # (сценарий, шаг) → [секунды]
+        self.updates = {}   # сценарий → апдейтов отправлено
+        self.timeouts = {}  # сценарий → шагов без ответа
+
+    def observe(self, scenario, step, seconds):
+        self.latency.setdefault((scenario, step), []).append(seconds)
+
+    def count(self, table, scenario):
+        table[scenario] = table.get(scenario, 0) + 1
+
+class NoReply(Exception):
+    pass
+
+class User:
+    """Один пользователь Telegram: шлёт апдейты и нажимает кнопки из ответов бота"""
+
+    def __init__(self, api, stats, user_id, rng):
+        self.api = api
+        self.stats = stats
+        self.id = user_id
+        self.rng = rng
+        self.message = None
+        self.buttons = []
+        self.scenario = None
+
+    def _from(self):
+        return {'id': self.id, 'is_bot': False, 'first_name': f'User{self.id}', 'username': f'user{self.id}'}
+
+    async def _send(self, step, update, callback_id=None):
+        future = self.api.expect(self.id)
+        if callback_id:
+            self.api.callbacks[callback_id] = self.id
+        start = time.perf_counter()
+        self.api.push(update)
+        self.stats.count(self.stats.updates, self.scenario)
+        try:
+            method, message, buttons = await asyncio.wait_for(future, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.count(self.stats.timeouts, self.scenario)
+            raise NoReply(step)
+        self.stats.observe(self.scenario, step, time.perf_counter() - start)
+        if message is not None:
+            self.message, self.buttons = message, buttons
+
+    async def say(self, step, text):
+        message = {'message_id': next(self.api.message_ids), 'date': int(time.time()),
+                   'chat': {'id': self.id, 'type': 'private'}, 'from': self._from(), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self._send(step, {'message': message})
+
+    def find(self, match):
+        return [b for b in self.buttons if 'callback_data' in b and match(b)]
+
+    async def click(self, step, match):
+        buttons = self.find(match)
+        if not buttons or self.message is None:
+            raise NoReply(step)
+        callback_id = str(next(self.api.message_ids))
+        await self._send(step, {'callback_query': {
+            'id': callback_id, 'from': self._from(), 'chat_instance': str(self.id),
+            'message': self.message, 'data': self.rng.choice(buttons)['callback_data']}}, callback_id)
+
+    async def think(self, mean):
+        await asyncio.sleep(self.rng.expovariate(1 / mean) if mean > 0 else 0)
+
+def code(prefix):
+    return lambda button: button['callback_data'].startswith(prefix)
+
+async def browse(user, think):
+    """Каталог → категория → 0–3 страницы вперёд → карточка товара"""
+    await user.say('start', '/start')
+    await user.think(think)
+    await user.click('catalog', lambda b: b['callback_data'] == 'c')
+    await user.think(think)
+    await user.click('category', code('k:'))
+    for _ in range(user.rng.randint(0, 3)):
+        if not user.find(lambda b: b['text'] == '➡️'):
+            break
+        await user.think(think)
+        await user.click('page', lambda b: b['text'] == '➡️')
+    await user.think(think)
+    await user.click('product', code('p:'))
+
+async def buy(user, think):
+    """Каталог → категория → товар → «Заказать»"""
+    await user.say('start', '/start')
+    await user.think(think)
+    await user.click('catalog', lambda b: b['callback_data'] == 'c')
+    await user.think(think)
+    await user.click('category', code('k:'))
+    await user.think(think)
+    await user.click('product', code('p:'))
+    await user.think(think)
+    await user.click('buy', code('b:'))
+
+async def order_link(user, think):
+    """Заказ по ссылке: три шага FSM OrderLink"""
+    await user.say('start', '/start')
+    await user.think(think)
+    await user.click('order_link', lambda b: b['callback_data'] == 'o')
+    await user.think(think)
+    await user.say('link', f"https://dw4.co/t/A/{user.rng.randrange(10 ** 9)}")
+    await user.think(think)
+    await user.say('size', user.rng.choice(['42', 'M', '38.5']))
+    await user.think(think)
+    await user.say('comment', 'без комментария')
+
+SCENARIOS = {'browse': browse, 'buy': buy, 'order_link': order_link}
+
+async def run_user(api, stats, user_id, args, delay):
+    rng = random.Random(args.seed * 1000003 + user_id)
+    user = User(api, stats, user_id, rng)
+    names = list(SCENARIOS)
+    weights = [args.mix[name] for name in names]
+    await asyncio.sleep(delay)
+    while True:
+        user.scenario = rng.choices(names, weights)[0]
+        try:
+            await SCENARIOS[user.scenario](user, args.think)
+        except NoReply:
+            pass
+        await user.think(args.think * 3)
+
+# ===== ПОСТЫ В КАНАЛ =====
+async def post_channel(api, stats, args, first_post, sent):
+    """Посты с фото в канал с частотой args.posts в секунду"""
+    rng = random.Random(args.seed)
+    for post_id in itertools.count(first_post):
+        api.push({'channel_post': {
+            'message_id': post_id, 'date': int(time.time()), 'chat': CHANNEL_CHAT,
+            'photo': [{'file_id': f'post{post_id}', 'file_unique_id': f'load{post_id}', 'width': 1, 'height': 1}],
+            'caption': caption(rng, post_id)}})
+        sent[post_id] = time.perf_counter()
+        stats.count(stats.updates, 'channel')
+        await asyncio.sleep(rng.expovariate(args.posts))
+
+async def watch_ingest(db_path, stats, sent, first_post, stop):
+    """Опрос БД бота: когда пост стал товаром"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    last = first_post - 1
+    try:
+        while not stop.is_set():
+            rows = conn.execute("SELECT post_id FROM products WHERE post_id > ? ORDER BY post_id", (last,)).fetchall()
+            now = time.perf_counter()
+            for (post_id,) in rows:
+                if post_id in sent:
+                    stats.observe('channel', 'ingest', now - sent.pop(post_id))
+                last = max(last, post_id)
+            await asyncio.sleep(0.05)
+    finally:
+        conn.close()
+
+# ===== ОТЧЁТ =====
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+def report(stats, elapsed, lost_posts):
+    rows = []
+    scenarios = sorted({scenario for scenario, _ in stats.latency} | set(stats.updates))
+    for scenario in scenarios:
+        steps = {step: values for (name, step), values in stats.latency.items() if name == scenario}
+        everything = [v for values in steps.values() for v in values]
+        rows.append({'scenario': scenario, 'step': '*', 'count': len(everything),
+                     'updates_per_sec': stats.updates.get(scenario, 0) / elapsed,
+                     'timeouts': stats.timeouts.get(scenario, 0) + (lost_posts if scenario == 'channel' else 0),
+                     **{f'p{int(q * 100)}_ms': quantile(everything, q) * 1000 for q in (0.5, 0.95, 0.99)}})
+        for step, values in steps.items():
+            rows.append({'scenario': scenario, 'step': step, 'count': len(values),
+                         **{f'p{int(q * 100)}_ms': quantile(values, q) * 1000 for q in (0.5, 0.95, 0.99)}})
+
+    print(f"\n{'сценарий / шаг':<24}{'ответов':>9}{'апд/с':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'без ответа':>12}")
+    for row in rows:
+        name = row['scenario'] if row['step'] == '*' else f"  {row['step']}"
+        rate = f"{row['updates_per_sec']:.1f}" if 'updates_per_sec' in row else ''
+        timeouts = str(row['timeouts']) if 'timeouts' in row else ''
+        print(f"{name:<24}{row['count']:>9}{rate:>9}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{timeouts:>12}")
+    total = sum(stats.updates.values())
+    print(f"\nВсего апдейтов: {total} за {elapsed:.1f} с — {total / elapsed:.1f} апд/с")
+    return rows
+
+# ===== ЗАПУСК =====
+def parse_mix(text):
+    mix = dict(item.split('=') for item in text.split(','))
+    return {name: float(mix.get(name, 0)) for name in SCENARIOS}
+
+async def main(args):
+    work = args.workdir or tempfile.mkdtemp(prefix='poizon-load-')
+    os.makedirs(work, exist_ok=True)
+    env = dict(os.environ, BOT_TOKEN=TOKEN, ADMIN_ID=str(ADMIN_ID), ADMIN_DIGEST_WINDOW='0')
+    print(f"📂 {work}")
+
+    if not os.path.exists(os.path.join(work, 'poizon_bot.db')):
+        start = time.monotonic()
+        write_export(os.path.join(work, 'result.json'), args.products, args.seed)
+        subprocess.run([sys.executable, BOT, 'import', 'result.json'], cwd=work, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        print(f"📦 Каталог: {args.products} товаров за {time.monotonic() - start:.1f} с")
+
+    api = FakeBotApi()
+    runner, url = await api.start()
+    env['TELEGRAM_API_URL'] = url
+    log = open(os.path.join(work, 'bot.log'), 'w')
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, BOT], cwd=work, env=env, stdout=log, stderr=subprocess.STDOUT)
+    stats = Stats()
+    try:
+        await asyncio.wait_for(api.ready.wait(), 120)
+        # polling начинается раньше, чем готовы воркеры (WORKERS > 1): ждём ответа на /start
+        probe = User(api, Stats(), FIRST_USER - 1, random.Random(args.seed))
+        for _ in range(8):
+            try:
+                await probe.say('start', '/start')
+                break
+            except NoReply:
+                pass
+        else:
+            raise RuntimeError(f"бот не отвечает, лог: {os.path.join(work, 'bot.log')}")
+        print(f"🤖 Бот отвечает через {time.monotonic() - started:.1f} с "
+              f"(WORKERS={env.get('WORKERS', '1')}, CATALOG_MODE={env.get('CATALOG_MODE', 'memory')})")
+
+        # номера постов продолжают те, что уже есть в БД (папку можно переиспользовать)
+        with sqlite3.connect(os.path.join(work, 'poizon_bot.db')) as conn:
+            first_post = (conn.execute("SELECT MAX(post_id) FROM products").fetchone()[0] or 0) + 1
+        sent = {}
+        stop = asyncio.Event()
+        cpu = resource.getrusage(resource.RUSAGE_SELF)
+        begin = time.monotonic()
+        tasks = [asyncio.create_task(run_user(api, stats, FIRST_USER + i, args, args.ramp * i / max(args.users, 1)))
+                 for i in range(args.users)]
+        if args.posts > 0:
+            tasks.append(asyncio.create_task(post_channel(api, stats, args, first_post, sent)))
+        watcher = asyncio.create_task(watch_ingest(os.path.join(work, 'poizon_bot.db'), stats, sent, first_post, stop))
+        await asyncio.sleep(args.duration)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.monotonic() - begin
+        await asyncio.sleep(3)  # досчитать последнюю пачку постов
+        stop.set()
+        await watcher
+        used = resource.getrusage(resource.RUSAGE_SELF)
+        load = (used.ru_utime + used.ru_stime - cpu.ru_utime - cpu.ru_stime) / elapsed
+
+        rows = report(stats, elapsed, len(sent))
+        print(f"Генератор нагрузки: {load:.0%} CPU; запросов к Bot API: {sum(api.calls.values())}")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'args': {k: v for k, v in vars(args).items()},
+                           'env': {k: env.get(k) for k in ('WORKERS', 'CATALOG_MODE', 'DB_READERS')},
+                           'elapsed': elapsed, 'rows': rows}, f, ensure_ascii=False, indent=1)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.to_thread(process.wait, 60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        await runner.cleanup()
+        if process.returncode not in (0, -signal.SIGINT):
+            print(f"⚠️ Бот завершился с кодом {process.returncode}, лог: {os.path.join(work, 'bot.log')}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=500, help='одновременных пользователей')
+    parser.add_argument('--duration', type=float, default=60, help='секунд нагрузки')
+    parser.add_argument('--ramp', type=float, default=5, help='за сколько секунд подключаются все пользователи')
+    parser.add_argument('--think', type=float, default=1.0, help='среднее время между нажатиями, с')
+    parser.add_argument('--products', type=int, default=20000, help='товаров в синтетическом каталоге')
+    parser.add_argument('--posts', type=float, default=2.0, help='постов в канал в секунду (0 — без постов)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('browse=70,buy=15,order_link=15'),
+                        help='доли сценариев, например browse=70,buy=15,order_link=15')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='папка с БД: каталог генерируется, только если БД ещё нет')
+    parser.add_argument('--json', help='записать итог в JSON — для сравнения прогонов')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""Бенчмарк разбора подписей: старый parse_product_data против CaptionParser.
+
+Запуск: python bench/parser.py [повторов] [товаров для пересчёта]
+Парсеры гоняются по корпусу captions.json вперемешку, берётся лучший замер
+каждого. Отдельно меряются только название и цена: категория в обеих версиях
+определяется одним и тем же detect_category и занимает половину времени.
+В конце в пустую БД во временной папке пишутся товары с описаниями из корпуса
+и считается скорость reparse_prices. Эталон корпуса проверяет tests/test_parser.py.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+from common import bot
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captions.json')
+
+def old_fields(text, message_id):
+    """Название и цена из parse_product_data до CaptionParser"""
+    price = "Цена в ЛС"
+    match1 = re.search(r'(\d[\d\s]+?)\s*[₽руб$RUB]', text, re.IGNORECASE)
+    if match1:
+        price = match1.group(1).replace(' ', '')
+    else:
+        match2 = re.search(r'цена[\s\-:]+(\d[\d\s]+)', text, re.IGNORECASE)
+        if match2:
+            price = match2.group(1).replace(' ', '')
+        else:
+            match3 = re.search(r'\b(\d{3,})\b', text)
+            if match3:
+                price = match3.group(1)
+
+    lines = text.split('\n')
+    if lines and len(lines[0]) > 5:
+        title = lines[0][:60].strip()
+    else:
+        title = text[:60].strip() or f"Товар #{message_id}"
+    return title, price
+
+def old_parse(text, message_id):
+    """parse_product_data до CaptionParser"""
+    return (*old_fields(text, message_id), bot.detect_category(text))
+
+def new_fields(text, message_id):
+    """Название и цена так же, как их берёт parse_product_data"""
+    return bot.caption_parser.title(text) or f"Товар #{message_id}", bot.stored_price(*bot.caption_parser.price(text))
+
+PARSERS = (("старый parse_product_data", lambda text: old_parse(text, 0)),
+           ("новый parse_product_data", lambda text: bot.parse_product_data(text, 0)),
+           ("старые название и цена", lambda text: old_fields(text, 0)),
+           ("новые название и цена", lambda text: new_fields(text, 0)),
+           ("CaptionParser.parse", bot.caption_parser.parse))
+
+def per_second(texts, rounds, repeats=7):
+    """Подписей в секунду для каждого парсера: замеры идут по кругу, от каждого — лучший"""
+    best = {name: 0 for name, _ in PARSERS}
+    for _ in range(repeats):
+        for name, parse in PARSERS:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for text in texts:
+                    parse(text)
+            best[name] = max(best[name], rounds * len(texts) / (time.perf_counter() - start))
+    return best
+
+def reparse(corpus, products):
+    """Товары с описаниями из корпуса и неверными ценами старого парсера → reparse_prices"""
+    bot.setup(load_catalog=False)
+    rows = []
+    for i in range(products):
+        text = corpus[i % len(corpus)]['text']
+        title, price = old_fields(text, i)
+        rows.append((title, text[:300], price, bot.price_number(price), bot.CHANNEL_ID, i + 1, '🎒 Другое', None))
+    bot.db.write_sync(bot.import_batch, 'bench', rows, products)
+    checked, changed, seconds = bot.db.write_sync(bot.reparse_prices)
+    bot.db.close()
+    return checked, changed, seconds
+
+def main(rounds, products):
+    with open(CORPUS, encoding='utf-8') as f:
+        corpus = json.load(f)
+    old_wrong = sum(old_fields(case['text'], 0)[1] != bot.stored_price(case['price'], case['currency'])
+                    for case in corpus)
+    print(f"корпус: {len(corpus)} подписей, старый парсер ошибался в цене: {old_wrong}")
+
+    texts = [case['text'] for case in corpus]
+    rates = (per_second(texts, rounds), per_second([text for text in texts if len(text) > 150], rounds))
+    print(f"\n{'подписей/с':<28}{'весь корпус':>12}{'длинные':>10}")
+    for name, _ in PARSERS:
+        print(f"{name:<28}{rates[0][name]:>12.0f}{rates[1][name]:>10.0f}")
+    for label, old, new in (("ускорение", "старый parse_product_data", "новый parse_product_data"),
+                            ("  название и цена", "старые название и цена", "новые название и цена")):
+        print(f"{label:<28}{rates[0][new] / rates[0][old]:>11.2f}x{rates[1][new] / rates[1][old]:>9.2f}x")
+
+    checked, changed, seconds = reparse(corpus, products)
+    print(f"\nreparse_prices: {checked} товаров, изменено {changed}, "
+          f"{checked / max(seconds, 1e-9):.0f} подписей/с за {seconds:.2f} с")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -1,220 +1,2760 @@
 import os
 import asyncio
+import bisect
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import multiprocessing
+import pickle
+import random
+import secrets
+import shutil
+import time
 import re
+import signal
 import sqlite3
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+import sys
+import tempfile
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+STARTED_AT = time.monotonic()  # отсчёт старта — до тяжёлых импортов aiogram
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
+from aiogram.types import (Update, Message, CallbackQuery, InlineQuery, InlineKeyboardButton, InlineKeyboardMarkup,
+                           InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent,
+                           InputMediaPhoto)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 
 # ===== КОНФИГУРАЦИЯ =====
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 CHANNEL_ID = "@poizonlab2"  # НОВЫЙ КАНАЛ
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://poizon.up.railway.app
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv('WEBHOOK_MAX_INFLIGHT', '100'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # /metrics в polling-режиме; 0 — не поднимать сервер
+WORKERS = int(os.getenv('WORKERS', '1'))  # >1 — приёмник раздаёт апдейты процессам-воркерам
+# Свой Bot API сервер (telegram-bot-api или заглушка из bench/loadtest.py), по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
+router = Router()
+
+# ===== МЕТРИКИ =====
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Гистограмма задержек с фиксированными корзинами (как в Prometheus)"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                low = LATENCY_BUCKETS[i - 1] if i else 0.0
+                high = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return LATENCY_BUCKETS[-1]
+
+class Metrics:
+    """Задержки обработчиков, SQL и Bot API + счётчики проглоченных ошибок"""
+
+    NAMES = {
+        'update': ('poizon_update_seconds', 'type'),
+        'handler': ('poizon_handler_seconds', 'handler'),
+        'db': ('poizon_db_seconds', 'query'),
+        'db_wait': ('poizon_db_wait_seconds', 'pool'),
+        'api': ('poizon_api_seconds', 'method'),
+    }
+
+    def __init__(self):
+        self.histograms = {kind: {} for kind in self.NAMES}
+        self.errors = {}
+        self.gauges = {}
+        self.shared = None  # WORKERS > 1: папка, куда воркеры сохраняют свои метрики
+        self.worker = None  # номер воркера; у приёмника и в однопроцессном режиме None
+        self._lock = threading.Lock()  # SQL-таймеры пишут из потоков БД
+
+    def observe(self, kind, label, seconds):
+        with self._lock:
+            histogram = self.histograms[kind].get(label)
+            if histogram is None:
+                histogram = self.histograms[kind][label] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, where):
+        with self._lock:
+            self.errors[where] = self.errors.get(where, 0) + 1
+
+    def error_counts(self):
+        """Копия счётчиков ошибок: словарь меняют потоки БД"""
+        with self._lock:
+            return dict(self.errors)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def dump(self):
+        """Копия метрик для файла воркера: гистограммы, ошибки и текущие значения gauge"""
+        with self._lock:
+            histograms = {kind: {label: (h.counts[:], h.sum, h.count) for label, h in items.items()}
+                          for kind, items in self.histograms.items()}
+        return {'histograms': histograms, 'errors': self.error_counts(),
+                'gauges': {name: callback() for name, callback in self.gauges.items()}}
+
+    def merge(self, state):
+        """Прибавить метрики другого воркера из dump(): гистограммы и ошибки складываются, gauge — нет"""
+        with self._lock:
+            for kind, items in state['histograms'].items():
+                for label, (counts, total, count) in items.items():
+                    histogram = self.histograms[kind].setdefault(label, Histogram())
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                    histogram.sum += total
+                    histogram.count += count
+            for where, n in state['errors'].items():
+                self.errors[where] = self.errors.get(where, 0) + n
+
+    def workers(self):
+        """Сохранённые метрики воркеров, кроме своего: [(номер, dump())] по возрастанию номера"""
+        workers = []
+        for name in os.listdir(self.shared) if self.shared else ():
+            match = re.fullmatch(r'worker-(\d+)\.pickle', name)
+            if not match or int(match.group(1)) == self.worker:
+                continue
+            try:
+                with open(os.path.join(self.shared, name), 'rb') as f:
+                    workers.append((int(match.group(1)), pickle.load(f)))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+        return sorted(workers, key=lambda item: item[0])
+
+    def render_prometheus(self, workers=()):
+        """Текст для /metrics; workers — [(номер, dump())], их ряды идут с меткой worker"""
+        parts = [('', self.dump())] + [(f'worker="{index}"', state) for index, state in workers]
+        lines = []
+        for kind, (name, label_name) in self.NAMES.items():
+            lines.append(f"# TYPE {name} histogram")
+            for worker, state in parts:
+                for label, (counts, total, count) in state['histograms'][kind].items():
+                    labels = ",".join(filter(None, (worker, f'{label_name}="{label}"')))
+                    cumulative = 0
+                    for le, n in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                        cumulative += n
+                        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+                    lines.append(f"{name}_count{{{labels}}} {count}")
+        lines.append("# TYPE poizon_errors_total counter")
+        for worker, state in parts:
+            for where, n in state['errors'].items():
+                labels = ",".join(filter(None, (worker, f'where="{where}"')))
+                lines.append(f'poizon_errors_total{{{labels}}} {n}')
+        for name in dict.fromkeys(name for _, state in parts for name in state['gauges']):
+            lines.append(f"# TYPE {name} gauge")
+            for worker, state in parts:
+                if name in state['gauges']:
+                    lines.append(f"{name}{{{worker}}} {state['gauges'][name]}" if worker
+                                 else f"{name} {state['gauges'][name]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, kind, top=8):
+        """Строки для /perf: самые частые метки с p50/p95/p99 в мс"""
+        with self._lock:
+            items = sorted(self.histograms[kind].items(), key=lambda kv: -kv[1].count)[:top]
+            return [f"{label}: {h.count} | {h.quantile(0.5) * 1000:.1f} / {h.quantile(0.95) * 1000:.1f} / "
+                    f"{h.quantile(0.99) * 1000:.1f} мс" for label, h in items]
+
+metrics = Metrics()
+
+METRICS_SYNC = 5  # секунд между сохранениями метрик воркера в общую папку
+
+def write_worker_metrics(path, state):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+async def export_worker_metrics():
+    """Воркер: раз в METRICS_SYNC секунд сохраняет свои метрики — их отдают /metrics приёмника и /perf"""
+    path = os.path.join(metrics.shared, f"worker-{metrics.worker}.pickle")
+    while True:
+        try:
+            await asyncio.to_thread(write_worker_metrics, path, metrics.dump())
+        except Exception:
+            metrics.error('metrics')
+        await asyncio.sleep(METRICS_SYNC)
+
+class UpdateMetrics(BaseMiddleware):
+    """Полное время обработки апдейта (вместе с FSM и фильтрами)"""
+
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe('update', event.event_type, time.perf_counter() - start)
+
+class HandlerMetrics(BaseMiddleware):
+    """Время конкретного обработчика и его необработанные ошибки"""
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.error(name)
+            raise
+        finally:
+            metrics.observe('handler', name, time.perf_counter() - start)
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Время каждого запроса к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.error(f"api.{name}")
+            raise
+        finally:
+            metrics.observe('api', name, time.perf_counter() - start)
+
+# кнопки меряет dispatch_callback — по коду действия, а не одним «dispatch_callback»
+for observer in (router.message, router.channel_post, router.inline_query):
+    observer.middleware(HandlerMetrics())
+bot.session.middleware(ApiMetrics())
+
+# ===== КАТЕГОРИИ =====
+CATEGORIES = {
+    '👟 Обувь': ['кроссовки', 'кросс', 'ботинки', 'тапки', 'сланцы', 'slides', 'туфли', 'boots', 'sneakers', 'air force', 'dunk'],
+    '🧥 Верхняя одежда': ['куртка', 'пуховик', 'пальто', 'парка', 'ветровка', 'бомбер', 'jacket', 'coat', 'hoodie', 'худи', 'толстовка', 'свитшот', 'кофта'],
+    '👕 Одежда': ['футболка', 'майка', 'шорты', 'джинсы', 'брюки', 'штаны', 'рубашка', 'shirt', 'pants', 'jeans', 'tshirt', 'tee', 'polo', 'свитер'],
+    '👜 Сумки': ['сумка', 'рюкзак', 'сумочка', 'клатч', 'кошелек', 'портмоне', 'bag', 'backpack', 'wallet', 'crossbody', 'messenger', 'поясная'],
+    '⌚️ Аксессуары': ['часы', 'браслет', 'цепь', 'кольцо', 'серьги', 'очки', 'кепка', 'шапка', 'перчатки', 'ремень', 'носки', 'watch', 'belt', 'cap', 'hat', 'glasses', 'chain', 'подвеска'],
+    '💄 Косметика': ['крем', 'помада', 'тушь', 'духи', 'парфюм', 'маска', 'сыворотка', 'тональ', 'пудра', 'лак', 'лосьон', 'косметика', 'perfume', 'cream', 'serum', 'lipstick', 'блеск'],
+    '🎒 Другое': []
+}
+
+# Порядок проверки: если в тексте есть слова нескольких категорий, побеждает более ранняя
+CATEGORY_PRIORITY = ['🧥 Верхняя одежда', '👕 Одежда', '👟 Обувь', '👜 Сумки', '⌚️ Аксессуары', '💄 Косметика']
+
+# ===== ОТПЕЧАТКИ ПОСТОВ =====
+# Повторы одного товара (репост, пересылка с другим message_id) ловятся по
+# file_unique_id фото и по MinHash-подписи текста. Подпись режется на LSH-полосы:
+# у похожих текстов совпадает хотя бы одна полоса, и кандидаты ищутся по индексу.
+MINHASH_SIZE = 32
+MINHASH_BANDS = 8        # 8 полос по 4 значения: в кандидаты попадают тексты от ~60% общих пар слов
+NEAR_DUPLICATE = 0.85    # оценка сходства, начиная с которой пост — повтор (при той же цене)
+MIN_SHINGLES = 4         # у более коротких подписей сравнивается только фото
+_MERSENNE = (1 << 61) - 1
+_seeds = random.Random(61)  # фиксированные параметры — подписи одинаковы во всех процессах
+MINHASH_PARAMS = [(_seeds.randrange(1, _MERSENNE), _seeds.randrange(_MERSENNE)) for _ in range(MINHASH_SIZE)]
+
+def shingles(text):
+    """Хэши пар соседних слов; регистр, эмодзи и пунктуация не влияют"""
+    words = re.findall(r'\w+', text.lower())
+    return {zlib.crc32(f"{a} {b}".encode()) for a, b in zip(words, words[1:])}
+
+def minhash(text):
+    """MinHash-подпись текста или None, если текст слишком короткий"""
+    hashes = shingles(text)
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    return array('Q', [min((a * h + b) % _MERSENNE for h in hashes) for a, b in MINHASH_PARAMS])
+
+def signature_from_blob(blob):
+    signature = array('Q')
+    signature.frombytes(blob)
+    return signature
+
+def band_keys(signature):
+    rows = MINHASH_SIZE // MINHASH_BANDS
+    return [(band << 32) | zlib.crc32(signature[band * rows:(band + 1) * rows].tobytes())
+            for band in range(MINHASH_BANDS)]
+
+def similarity(a, b):
+    """Оценка коэффициента Жаккара по двум подписям"""
+    return sum(x == y for x, y in zip(a, b)) / MINHASH_SIZE
+
+def find_duplicate(conn, photo_uid, signature, price):
+    """id товара, повтором которого является пост, или None.
+
+    И по фото, и по тексту повтор — только при той же цене: то же фото с новой
+    ценой — новый пост о товаре, и цена из него не должна теряться.
+    """
+    if photo_uid:
+        row = conn.execute("SELECT id FROM products WHERE photo_uid=? AND price=?", (photo_uid, price)).fetchone()
+        if row:
+            return row[0]
+    if signature is None:
+        return None
+    keys = band_keys(signature)
+    for pid, blob, other_price in conn.execute(
+            f"SELECT id, minhash, price FROM products WHERE id IN "
+            f"(SELECT product_id FROM product_bands WHERE band IN ({','.join('?' * len(keys))}) LIMIT 50)", keys):
+        if other_price == price and similarity(signature, signature_from_blob(blob)) >= NEAR_DUPLICATE:
+            return pid
+    return None
+
+def store_fingerprint(conn, pid, signature):
+    """Подпись и полосы товара; пустая подпись — текст слишком короткий, пересчитывать не нужно"""
+    conn.execute("UPDATE products SET minhash=? WHERE id=?", (signature.tobytes() if signature else b'', pid))
+    if signature:
+        conn.executemany("INSERT OR IGNORE INTO product_bands (band, product_id) VALUES (?, ?)",
+                         [(key, pid) for key in band_keys(signature)])
+
+def duplicate_products(conn):
+    """Повторы по всей таблице: одинаковое фото или близкий текст — при той же цене.
+    Из каждой группы остаётся самый старый товар, возвращаются id остальных"""
+    parent = {}
+
+    def find(pid):
+        root = pid
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while pid != root:
+            parent[pid], pid = root, parent.get(pid, pid)
+        return root
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    for column in ('photo', 'photo_uid'):
+        for (ids,) in conn.execute(f"SELECT group_concat(id) FROM products WHERE {column} IS NOT NULL "
+                                   f"GROUP BY {column}, price HAVING COUNT(*) > 1"):
+            first, *rest = map(int, ids.split(','))
+            for pid in rest:
+                union(first, pid)
+
+    fingerprints = {pid: (signature_from_blob(blob), price) for pid, blob, price in conn.execute(
+        "SELECT id, minhash, price FROM products WHERE length(minhash) > 0")}
+    for (ids,) in conn.execute("SELECT group_concat(product_id) FROM product_bands GROUP BY band HAVING COUNT(*) > 1"):
+        ids = sorted(pid for pid in map(int, ids.split(',')) if pid in fingerprints)[:200]
+        for i, a in enumerate(ids):
+            signature, price = fingerprints[a]
+            for b in ids[i + 1:]:
+                if fingerprints[b][1] == price and find(a) != find(b) \
+                        and similarity(signature, fingerprints[b][0]) >= NEAR_DUPLICATE:
+                    union(a, b)
+    return sorted(pid for pid in parent if find(pid) != pid)
+
+# ===== БАЗА ДАННЫХ =====
+DB_PATH = 'poizon_bot.db'
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+CATALOG_MODE = os.getenv('CATALOG_MODE', 'memory')  # sql — страницы читаются из БД, каталог не держится в памяти
+CATALOG_SNAPSHOT = os.getenv('CATALOG_SNAPSHOT', 'catalog.snapshot')  # пустая строка — без снимка
+SNAPSHOT_INTERVAL = 30  # секунд: как часто проверять, не пора ли переписать снимок
+SNAPSHOT_FORMAT = 2  # меняется вместе с составом строк каталога: старый снимок не подойдёт
+
+def add_column(conn, table, column, decl):
+    """Миграция: добавить колонку, если её ещё нет. True, если колонка добавлена"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def create_schema(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT,
+        price TEXT,
+        photo TEXT,
+        source TEXT,
+        post_id INTEGER UNIQUE,
+        category TEXT DEFAULT '🎒 Другое',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Отпечатки для поиска повторов (см. ОТПЕЧАТКИ ПОСТОВ)
+    add_column(conn, 'products', 'photo_uid', 'TEXT')
+    add_column(conn, 'products', 'minhash', 'BLOB')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_photo_uid ON products(photo_uid) WHERE photo_uid IS NOT NULL')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS product_bands (
+        band INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        PRIMARY KEY (band, product_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_product_bands_product ON product_bands(product_id)')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_bands_delete AFTER DELETE ON products BEGIN
+        DELETE FROM product_bands WHERE product_id = old.id;
+    END
+    ''')
+
+    # Цена числом (рубли, NULL — «Цена в ЛС»): для сортировки и фильтра по бюджету.
+    # Досчитывается на каждом старте: ALTER уже закоммичен, и упавший пересчёт не должен оставить товары без цен
+    add_column(conn, 'products', 'price_value', 'INTEGER')
+    values = [(price_number(price), pid) for pid, price in conn.execute(
+        "SELECT id, price FROM products WHERE price_value IS NULL AND price GLOB '[0-9]*'")]
+    conn.executemany("UPDATE products SET price_value=? WHERE id=?", [row for row in values if row[0] is not None])
+
+    # Страницы каталога: keyset по (category, created_at, id), индекс покрывает кнопки (name, price_value)
+    conn.execute("UPDATE products SET created_at=CURRENT_TIMESTAMP WHERE created_at IS NULL")
+    conn.execute('DROP INDEX IF EXISTS idx_products_category_created')
+    conn.execute('DROP INDEX IF EXISTS idx_products_created')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category_recent ON products(category, created_at, id, name, price_value)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_recent ON products(created_at, id, name, price_value)')
+    # ...и по цене: keyset по (category, price_value, id)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category_price ON products(category, price_value, id, name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_price ON products(price_value, id, name)')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        full_name TEXT,
+        product TEXT,
+        price TEXT,
+        type TEXT,
+        status TEXT DEFAULT 'new',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    add_column(conn, 'orders', 'product_id', 'INTEGER')
+    # Очередь заказов в админке: keyset по (status, id), индексы покрывают строку списка
+    conn.execute('DROP INDEX IF EXISTS idx_orders_status')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_id ON orders(status, id, type, username, product, price)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_type_id ON orders(status, type, id, username, product, price)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)')
+
+    # Сводки по заказам: обновляются в той же транзакции, что и сам заказ
+    stats_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='order_stats'").fetchone()
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS order_stats (
+        day TEXT,
+        type TEXT,
+        status TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, type, status)
+    ) WITHOUT ROWID
+    ''')
+    if not stats_exists:
+        conn.execute('''INSERT INTO order_stats (day, type, status, count)
+                        SELECT date(created_at), type, status, COUNT(*) FROM orders GROUP BY 1, 2, 3''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS product_stats (
+        product_id INTEGER PRIMARY KEY,
+        views INTEGER NOT NULL DEFAULT 0,
+        orders INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+
+    # Версия каталога: растёт при любом изменении products, по ней проверяется снимок
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0)")
+    conn.executescript('''
+    CREATE TRIGGER IF NOT EXISTS products_version_insert AFTER INSERT ON products BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_version_delete AFTER DELETE ON products BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_version_update AFTER UPDATE OF name, price, category, photo, created_at ON products BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+    END;
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        updated_at REAL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)')
+
+    # Подписки на категории: рассылка идёт по (category, user_id) курсором
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        category TEXT,
+        user_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (category, user_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id)')
+
+    # Задания рассылки: cursor — последний user_id, которому пачка уже ушла
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category TEXT,
+        text TEXT,
+        photo TEXT,
+        markup TEXT,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_pending ON broadcasts(id) WHERE done = 0')
+
+    # Полнотекстовый поиск: внешний FTS5-индекс по products, синхронизируется триггерами
+    fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'").fetchone()
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    conn.executescript('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END;
+    ''')
+    if not fts_exists:
+        conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+def keyset_page(conn, select, where, args, keys, cursor, direction, limit, descending=False):
+    """Keyset-страница для кнопок ⬅️/➡️.
+
+    select — «SELECT ... FROM таблица», where/args — фильтры, keys — колонки
+    ключа сортировки (последняя — id, чтобы ключ был уникальным), cursor —
+    значения keys у крайней строки соседней страницы. descending — порядок
+    списка с первой страницы; 'next' идёт дальше по нему, 'prev' — назад.
+    Читается limit+1 строк, чтобы понять, есть ли что-то дальше.
+    Если перед курсором меньше страницы — это уже начало списка, и вместо
+    неполной страницы отдаётся первая. Возвращает (строки, есть ли следующая
+    страница, отдана ли первая страница вместо запрошенной).
+    """
+    def fetch(cursor, direction):
+        conditions, params = list(where), list(args)
+        ascending = (direction == 'next') != descending
+        if cursor:
+            conditions.append(f"({', '.join(keys)}) {'>' if ascending else '<'} ({', '.join('?' * len(keys))})")
+            params += cursor
+        sort = "ASC" if ascending else "DESC"
+        rows = conn.execute(f"{select} {'WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+                            f"ORDER BY {', '.join(f'{key} {sort}' for key in keys)} LIMIT ?",
+                            (*params, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return (rows, more) if direction == 'next' else (rows[::-1], True)
+
+    rows, has_next = fetch(cursor, direction)
+    if direction == 'prev' and len(rows) < limit:
+        return (*fetch(None, 'next'), True)
+    return rows, has_next, False
+
+class Database:
+    """Доступ к SQLite вне event loop.
+
+    Все записи идут через один поток-писатель (очередь executor'а), чтения —
+    через небольшой пул потоков, у каждого потока своё соединение в режиме WAL.
+    """
+
+    def __init__(self, path, readers=4):
+        self.path = path
+        self.readers = readers
+        self._local = threading.local()
+        self._conns = []
+        self._writer = None
+        self._reader_pool = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        self._local.conn = conn
+        self._conns.append(conn)
+
+    def _run_write(self, queued_at, fn, *args):
+        conn = self._local.conn
+        start = time.perf_counter()
+        metrics.observe('db_wait', 'writer', start - queued_at)
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            metrics.error(f"db.{fn.__name__}")
+            raise
+        finally:
+            metrics.observe('db', fn.__name__, time.perf_counter() - start)
+
+    def _run_read(self, queued_at, fn, *args):
+        start = time.perf_counter()
+        metrics.observe('db_wait', 'readers', start - queued_at)
+        try:
+            return fn(self._local.conn, *args)
+        except BaseException:
+            metrics.error(f"db.{fn.__name__}")
+            raise
+        finally:
+            metrics.observe('db', fn.__name__, time.perf_counter() - start)
+
+    def open(self):
+        self._writer = ThreadPoolExecutor(1, 'db-writer', initializer=self._connect)
+        self._reader_pool = ThreadPoolExecutor(self.readers, 'db-reader', initializer=self._connect)
+        self.write_sync(create_schema)
+
+    def close(self):
+        for pool in (self._writer, self._reader_pool):
+            if pool:
+                pool.shutdown(wait=True)
+        for conn in self._conns:
+            conn.close()
+        self._conns.clear()
+
+    def write_sync(self, fn, *args):
+        """Синхронная запись — только для старта, до запуска event loop"""
+        return self._writer.submit(self._run_write, time.perf_counter(), fn, *args).result()
+
+    def read_sync(self, fn, *args):
+        return self._reader_pool.submit(self._run_read, time.perf_counter(), fn, *args).result()
+
+    async def write(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._writer, self._run_write, time.perf_counter(), fn, *args)
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader_pool, self._run_read, time.perf_counter(), fn, *args)
+
+    # --- товары ---
+    async def insert_products(self, rows):
+        """Пачка товаров одной транзакцией.
+
+        rows — кортежи (name, description, price, photo, post_id, category, photo_uid, signature).
+        Возвращает для каждой строки пару: ('added', id) для нового товара,
+        ('photo', id), если пост уже пришёл из импорта экспорта без фото и фото
+        дописано, ('duplicate', None), если пост уже в базе, ('repost', id оригинала)
+        для повтора уже известного товара; None, если строку записать не удалось:
+        каждая строка — в своей точке сохранения, и ошибка в одном посте
+        не откатывает остальные.
+        """
+        def insert_product(conn, name, description, price, photo, post_id, category, photo_uid, signature):
+            existing = conn.execute("SELECT id, photo FROM products WHERE post_id=?", (post_id,)).fetchone()
+            if existing:
+                pid, stored = existing
+                if stored is not None or not photo:
+                    return 'duplicate', None
+                conn.execute("UPDATE products SET photo=?, photo_uid=COALESCE(photo_uid, ?) WHERE id=?",
+                             (photo, photo_uid, pid))
+                store_fingerprint(conn, pid, signature)
+                return 'photo', pid
+            original = find_duplicate(conn, photo_uid, signature, price)
+            if original is not None:
+                return 'repost', original
+            cur = conn.execute('''INSERT OR IGNORE INTO products (name, description, price, price_value, photo, source,
+                                                             post_id, category, photo_uid)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                               (name, description, price, price_number(price), photo, CHANNEL_ID, post_id, category,
+                                photo_uid))
+            if cur.rowcount <= 0:
+                return 'duplicate', None
+            store_fingerprint(conn, cur.lastrowid, signature)
+            return 'added', cur.lastrowid
+
+        def insert_products(conn):
+            results = []
+            if not conn.in_transaction:
+                conn.execute('BEGIN')  # иначе RELEASE внешней точки сохранения закоммитит каждую строку отдельно
+            for row in rows:
+                conn.execute('SAVEPOINT product')
+                try:
+                    results.append(insert_product(conn, *row))
+                except (sqlite3.Error, OverflowError, ValueError) as e:
+                    conn.execute('ROLLBACK TO product')
+                    metrics.error('ingest.row')
+                    print(f"❌ Пост {row[4]} не записан: {e}")
+                    results.append(None)
+                conn.execute('RELEASE product')
+            return results
+        return await self.write(insert_products)
+
+    async def recategorize_products(self, classify):
+        """Пересчёт категорий всех товаров одной транзакцией. Возвращает {id: (старая, новая категория)}"""
+        def recategorize_products(conn):
+            changed = {}
+            for pid, name, description, category in conn.execute(
+                    'SELECT id, name, description, category FROM products'):
+                new_category = classify(description or name)
+                if new_category != category:
+                    changed[pid] = (category, new_category)
+            conn.executemany("UPDATE products SET category=? WHERE id=?",
+                             [(new, pid) for pid, (old, new) in changed.items()])
+            return changed
+        return await self.write(recategorize_products)
+
+    async def reparse_prices(self):
+        return await self.write(reparse_prices)
+
+    async def fetch_descriptions(self, ids):
+        def fetch_descriptions(conn):
+            return conn.execute(f"SELECT id, description FROM products WHERE id IN ({','.join('?' * len(ids))})",
+                                ids).fetchall()
+        return await self.read(fetch_descriptions)
+
+    async def delete_product(self, pid):
+        """Удалить товар; возвращает его категорию или None, если товара уже нет"""
+        def delete_product(conn):
+            row = conn.execute("SELECT category FROM products WHERE id=?", (pid,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM products WHERE id=?", (pid,))
+            return row[0]
+        return await self.write(delete_product)
+
+    async def fetch_products_by_id(self, ids):
+        def fetch_products_by_id(conn):
+            return conn.execute(f"SELECT id, name, price_value, category, photo FROM products WHERE id IN ({','.join('?' * len(ids))})",
+                                ids).fetchall()
+        return await self.read(fetch_products_by_id)
+
+    async def newest_products(self, category, limit):
+        def newest_products(conn):
+            where, args = ("WHERE category=? ", (category,)) if category != 'all' else ("", ())
+            return conn.execute(f"SELECT id, name, price_value, category, photo FROM products {where}"
+                                f"ORDER BY created_at DESC, id DESC LIMIT ?", (*args, limit)).fetchall()
+        return await self.read(newest_products)
+
+    async def products_page(self, category, cursor=None, direction='next', limit=8):
+        """Страница кнопок каталога (id, name, price_value, created_at), новые сверху.
+
+        Keyset-пагинация (keyset_page): cursor — (created_at, id) крайнего товара
+        соседней страницы, поэтому глубокая страница стоит столько же, сколько первая.
+        'next' — товары старше курсора, 'prev' — новее.
+        """
+        def products_page(conn):
+            where, args = (["category=?"], [category]) if category != 'all' else ([], [])
+            return keyset_page(conn, "SELECT id, name, price_value, created_at FROM products", where, args,
+                               ('created_at', 'id'), cursor, direction, limit, descending=True)
+        return await self.read(products_page)
+
+    async def products_by_price(self, category, order='asc', low=None, high=None, cursor=None, direction='next', limit=8):
+        """Страница товаров с ценой (id, name, price_value) по цене и число товаров в диапазоне.
+
+        Цена в [low, high), order — 'asc' или 'desc'. Keyset по (price_value, id):
+        cursor — крайний товар соседней страницы. Запросы идут по индексам
+        idx_products_category_price / idx_products_price, без чтения строк таблицы.
+        """
+        def products_by_price(conn):
+            where, args = (["category=?"], [category]) if category != 'all' else ([], [])
+            where.append("price_value >= ?" if low else "price_value IS NOT NULL")
+            args += [low] if low else []
+            if high:
+                where.append("price_value < ?")
+                args.append(high)
+            total = conn.execute(f"SELECT COUNT(*) FROM products WHERE {' AND '.join(where)}", args).fetchone()[0]
+            return (*keyset_page(conn, "SELECT id, name, price_value FROM products", where, args,
+                                 ('price_value', 'id'), cursor, direction, limit, descending=order == 'desc'), total)
+        return await self.read(products_by_price)
+
+    async def products_without_fingerprint(self):
+        def products_without_fingerprint(conn):
+            return conn.execute("SELECT id, COALESCE(description, name) FROM products WHERE minhash IS NULL").fetchall()
+        return await self.read(products_without_fingerprint)
+
+    async def store_fingerprints(self, signatures):
+        """signatures — пары (id, подпись или None)"""
+        def store_fingerprints(conn):
+            for pid, signature in signatures:
+                store_fingerprint(conn, pid, signature)
+        return await self.write(store_fingerprints)
+
+    async def duplicate_products(self):
+        return await self.read(duplicate_products)
+
+    async def delete_products(self, ids):
+        def delete_products(conn):
+            conn.executemany("DELETE FROM products WHERE id=?", [(pid,) for pid in ids])
+        return await self.write(delete_products)
+
+    async def search_products(self, query, limit=20):
+        """id товаров по FTS-запросу, лучшие совпадения первыми (название весит больше описания)"""
+        def search_products(conn):
+            return [row[0] for row in conn.execute(
+                "SELECT rowid FROM products_fts WHERE products_fts MATCH ? "
+                "ORDER BY bm25(products_fts, 5.0, 1.0) LIMIT ?", (query, limit))]
+        return await self.read(search_products)
+
+    # --- заказы ---
+    async def save_order(self, order_data):
+        def save_order(conn):
+            cur = conn.execute('''INSERT INTO orders (user_id, username, full_name, product, price, type, product_id)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                               (order_data['user_id'], order_data['username'],
+                                order_data['full_name'], order_data['product'],
+                                order_data['price'], order_data['type'], order_data.get('product_id')))
+            conn.execute('''INSERT INTO order_stats (day, type, status, count) VALUES (date('now'), ?, 'new', 1)
+                            ON CONFLICT (day, type, status) DO UPDATE SET count = count + 1''',
+                         (order_data['type'],))
+            if order_data.get('product_id'):
+                conn.execute('''INSERT INTO product_stats (product_id, orders) VALUES (?, 1)
+                                ON CONFLICT (product_id) DO UPDATE SET orders = orders + 1''',
+                             (order_data['product_id'],))
+            return cur.lastrowid
+        return await self.write(save_order)
+
+    async def set_order_status(self, order_id, status, expected=None):
+        """Атомарная смена статуса вместе со сводкой. True, если заказ изменён"""
+        def set_order_status(conn):
+            row = conn.execute("SELECT status, type, date(created_at) FROM orders WHERE id=?", (order_id,)).fetchone()
+            if row is None or row[0] == status or (expected is not None and row[0] != expected):
+                return False
+            old_status, order_type, day = row
+            if conn.execute("UPDATE orders SET status=? WHERE id=? AND status=?",
+                            (status, order_id, old_status)).rowcount == 0:
+                return False
+            conn.execute("UPDATE order_stats SET count = count - 1 WHERE day=? AND type=? AND status=?",
+                         (day, order_type, old_status))
+            conn.execute('''INSERT INTO order_stats (day, type, status, count) VALUES (?, ?, ?, 1)
+                            ON CONFLICT (day, type, status) DO UPDATE SET count = count + 1''',
+                         (day, order_type, status))
+            return True
+        return await self.write(set_order_status)
+
+    async def count_orders(self, status=None, order_type=None):
+        """Число заказов из сводки — без прохода по orders"""
+        def count_orders(conn):
+            where, args = [], []
+            if status is not None:
+                where.append("status=?")
+                args.append(status)
+            if order_type is not None:
+                where.append("type=?")
+                args.append(order_type)
+            sql = f"SELECT COALESCE(SUM(count), 0) FROM order_stats {'WHERE ' + ' AND '.join(where) if where else ''}"
+            return conn.execute(sql, args).fetchone()[0]
+        return await self.read(count_orders)
+
+    async def order_status_counts(self):
+        """{статус: число заказов} из сводки"""
+        def order_status_counts(conn):
+            return dict(conn.execute("SELECT status, SUM(count) FROM order_stats GROUP BY status").fetchall())
+        return await self.read(order_status_counts)
+
+    async def orders_page(self, status, order_type=None, cursor=None, direction='next', limit=8):
+        """Страница очереди заказов (id, username, product, price, type), новые сверху.
+
+        Keyset по (status, id): cursor — id крайнего заказа соседней страницы,
+        'next' — заказы старше, 'prev' — новее. Запрос читает только индекс
+        idx_orders_status_id (с фильтром по типу — idx_orders_status_type_id).
+        """
+        def orders_page(conn):
+            where, args = ["status=?"], [status]
+            if order_type:
+                where.append("type=?")
+                args.append(order_type)
+            return keyset_page(conn, "SELECT id, username, product, price, type FROM orders", where, args,
+                               ('id',), cursor and (cursor,), direction, limit, descending=True)
+        return await self.read(orders_page)
+
+    async def get_order(self, order_id):
+        """(id, user_id, username, full_name, product, price, type, status, created_at) или None"""
+        def get_order(conn):
+            return conn.execute("SELECT id, user_id, username, full_name, product, price, type, status, created_at "
+                                "FROM orders WHERE id=?", (order_id,)).fetchone()
+        return await self.read(get_order)
+
+    async def order_report(self, days=7, top=5):
+        """Данные для экрана статистики: по дням, по типам, по статусам, топ товаров"""
+        def order_report(conn):
+            return {
+                'days': conn.execute('''SELECT day, SUM(count) FROM order_stats
+                                         GROUP BY day ORDER BY day DESC LIMIT ?''', (days,)).fetchall(),
+                'types': conn.execute("SELECT type, SUM(count) FROM order_stats GROUP BY type").fetchall(),
+                'statuses': conn.execute("SELECT status, SUM(count) FROM order_stats GROUP BY status").fetchall(),
+                'products': conn.execute('''SELECT product_id, views, orders FROM product_stats
+                                             WHERE orders > 0 ORDER BY orders DESC LIMIT ?''', (top,)).fetchall(),
+            }
+        return await self.read(order_report)
+
+    async def add_product_views(self, views):
+        def add_product_views(conn):
+            conn.executemany('''INSERT INTO product_stats (product_id, views) VALUES (?, ?)
+                                ON CONFLICT (product_id) DO UPDATE SET views = views + excluded.views''',
+                             list(views.items()))
+        return await self.write(add_product_views)
+
+    # --- состояния FSM ---
+    async def load_fsm_state(self, key, not_before):
+        def load_fsm_state(conn):
+            return conn.execute("SELECT state, data FROM fsm_states WHERE key=? AND updated_at>=?",
+                                (key, not_before)).fetchone()
+        return await self.read(load_fsm_state)
+
+    async def save_fsm_states(self, records):
+        """records — {key: (state, data, updated_at)}; пустые записи удаляются"""
+        def save_fsm_states(conn):
+            for key, (state, data, updated_at) in records.items():
+                if state is None and not data:
+                    conn.execute("DELETE FROM fsm_states WHERE key=?", (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                                 (key, state, json.dumps(data, ensure_ascii=False), updated_at))
+        return await self.write(save_fsm_states)
+
+    async def purge_fsm_states(self, not_before):
+        def purge_fsm_states(conn):
+            return conn.execute("DELETE FROM fsm_states WHERE updated_at<?", (not_before,)).rowcount
+        return await self.write(purge_fsm_states)
+
+    # --- подписки и рассылки ---
+    async def subscriptions(self, user_id):
+        def subscriptions(conn):
+            return {row[0] for row in conn.execute("SELECT category FROM subscriptions WHERE user_id=?", (user_id,))}
+        return await self.read(subscriptions)
+
+    async def set_subscription(self, user_id, category, subscribed):
+        def set_subscription(conn):
+            if subscribed:
+                conn.execute("INSERT OR IGNORE INTO subscriptions (category, user_id) VALUES (?, ?)", (category, user_id))
+            else:
+                conn.execute("DELETE FROM subscriptions WHERE category=? AND user_id=?", (category, user_id))
+        return await self.write(set_subscription)
+
+    async def subscribers_page(self, category, after, limit):
+        """user_id подписчиков категории больше after, по возрастанию"""
+        def subscribers_page(conn):
+            return [row[0] for row in conn.execute(
+                "SELECT user_id FROM subscriptions WHERE category=? AND user_id>? ORDER BY user_id LIMIT ?",
+                (category, after, limit))]
+        return await self.read(subscribers_page)
+
+    async def create_broadcasts(self, jobs):
+        """jobs — (category, text, photo, markup); задания для категорий без подписчиков не создаются"""
+        def create_broadcasts(conn):
+            conn.executemany(
+                "INSERT INTO broadcasts (category, text, photo, markup) SELECT ?, ?, ?, ? "
+                "WHERE EXISTS (SELECT 1 FROM subscriptions WHERE category=?)",
+                [(*job, job[0]) for job in jobs])
+        return await self.write(create_broadcasts)
+
+    async def next_broadcast(self):
+        """Самое старое незаконченное задание: (id, category, text, photo, markup, cursor, sent, failed, blocked)"""
+        def next_broadcast(conn):
+            return conn.execute('''SELECT id, category, text, photo, markup, cursor, sent, failed, blocked
+                                   FROM broadcasts WHERE done = 0 ORDER BY id LIMIT 1''').fetchone()
+        return await self.read(next_broadcast)
+
+    async def save_broadcast_progress(self, job_id, cursor, sent, failed, blocked, gone=(), done=False):
+        """Курсор и счётчики задания; gone — заблокировавшие бота, их подписки удаляются"""
+        def save_broadcast_progress(conn):
+            conn.execute("UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=?, done=? WHERE id=?",
+                         (cursor, sent, failed, blocked, int(done), job_id))
+            conn.executemany("DELETE FROM subscriptions WHERE user_id=?", [(user_id,) for user_id in gone])
+        return await self.write(save_broadcast_progress)
+
+db = Database(DB_PATH, DB_READERS)
+
+# ===== КАТАЛОГ В ПАМЯТИ =====
+class CatalogIndex:
+    """Индекс каталога: id → товар, списки по категориям и счётчики.
+
+    Списки хранятся от старых к новым, поэтому новый товар добавляется
+    в конец за O(1), а страница «новые сверху» берётся срезом с конца.
+    Для сортировки по цене отдельно держатся списки товаров с ценой,
+    упорядоченные по (цена, id): диапазон бюджета — два bisect.
+    Удаление ленивое: товар пропадает из by_id, а из списков его
+    выкидывает одна чистка при следующем чтении — пачка удалений
+    стоит O(k), а не O(n) на каждый товар.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.all = []
+        self.by_category = {}
+        self._by_price = None  # категория или 'all' → товары по (цена, id); строится при первом запросе
+        self._removed = {}  # категория или 'all' → сколько удалённых ещё лежит в её списках
+        self.version = 0  # растёт при каждом изменении — по нему сбрасываются кэши
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def clear(self):
+        self.by_id.clear()
+        self.all.clear()
+        self.by_category.clear()
+        self._by_price = None
+        self._removed.clear()
+        self.version += 1
+        cards.clear()
+
+    def add(self, product):
+        self.version += 1
+        self.by_id[product.id] = product
+        self.all.append(product)
+        self.by_category.setdefault(product.category, []).append(product)
+        if self._by_price is not None and product.price is not None:
+            for key in ('all', product.category):
+                bisect.insort(self._by_price.setdefault(key, []), product, key=price_key)
+
+    def load(self, rows):
+        self.clear()
+        for row in rows:
+            self.add(product_from_row(row))
+
+    def remove(self, pid, category=None):
+        product = self.by_id.pop(pid, None)
+        if product is None:
+            return None
+        self.version += 1
+        cards.discard(pid)
+        descriptions.discard(pid)
+        for key in ('all', product.category):
+            self._removed[key] = self._removed.get(key, 0) + 1
+        return product
+
+    def _live(self, key):
+        """Выкинуть удалённые товары из списков key — один проход на пачку удалений"""
+        if not self._removed.pop(key, 0):
+            return
+        alive = lambda product: self.by_id.get(product.id) is product
+        if key == 'all':
+            self.all[:] = filter(alive, self.all)
+        elif key in self.by_category:
+            self.by_category[key] = list(filter(alive, self.by_category[key]))
+        if self._by_price is not None and key in self._by_price:
+            self._by_price[key] = list(filter(alive, self._by_price[key]))
+
+    def get(self, pid):
+        return self.by_id.get(pid)
+
+    def set_photos(self, photos):
+        """Фото {id: file_id} для товаров, пришедших из импорта без фото"""
+        self.version += 1
+        for pid, photo in photos.items():
+            if pid in self.by_id:
+                self.by_id[pid].photo = photo
+                cards.discard(pid)
+
+    def set_categories(self, changed):
+        """Массовая смена категорий {id: (старая, новая)}; списки категорий пересобираются"""
+        self.version += 1
+        for pid, (_, category) in changed.items():
+            if pid in self.by_id:
+                self.by_id[pid].category = category
+                cards.discard(pid)
+        self._live('all')
+        self.by_category.clear()
+        for product in self.all:
+            self.by_category.setdefault(product.category, []).append(product)
+        self._by_price = None
+        self._removed.clear()
+
+    def count(self, category='all'):
+        items = self.all if category == 'all' else self.by_category.get(category, ())
+        return len(items) - self._removed.get(category, 0)
+
+    def page(self, category='all', page=0, per_page=8):
+        """Товары страницы, новые сверху"""
+        self._live(category)
+        items = self.all if category == 'all' else self.by_category.get(category, [])
+        end = len(items) - page * per_page
+        if end <= 0:
+            return []
+        return items[max(end - per_page, 0):end][::-1]
+
+    def by_price(self, category='all'):
+        if self._by_price is None:
+            self._live('all')
+            self._by_price = {}
+            for product in sorted((p for p in self.all if p.price is not None), key=price_key):
+                self._by_price.setdefault('all', []).append(product)
+                self._by_price.setdefault(product.category, []).append(product)
+        self._live(category)
+        return self._by_price.get(category, [])
+
+    def price_page(self, category='all', order='asc', low=None, high=None, page=0, per_page=8):
+        """Товары страницы с ценой в [low, high) по цене и их число в диапазоне"""
+        items = self.by_price(category)
+        start = bisect.bisect_left(items, (low, 0), key=price_key) if low else 0
+        end = bisect.bisect_left(items, (high, 0), key=price_key) if high else len(items)
+        if order == 'asc':
+            first = start + page * per_page
+            return items[first:min(first + per_page, end)], end - start
+        last = end - page * per_page
+        return (items[max(last - per_page, start):last][::-1] if last > start else []), end - start
+
+    # Асинхронный интерфейс общий с SqlCatalog — обработчики не знают, где лежит каталог
+    async def fetch(self, pid):
+        return self.by_id.get(pid)
+
+    async def fetch_many(self, ids):
+        return [p for p in map(self.by_id.get, ids) if p]
+
+    async def newest(self, category='all', limit=8):
+        return self.page(category, 0, limit)
+
+class SqlCatalog:
+    """Каталог в БД (CATALOG_MODE=sql): в памяти только счётчики по категориям
+    и LRU недавно открытых товаров, страницы читаются keyset-запросами.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.counts = {}
+        self.total = 0
+        self.version = 0
+        self._recent = OrderedDict()
+
+    def __len__(self):
+        return self.total
+
+    def remember(self, product):
+        self._recent[product.id] = product
+        self._recent.move_to_end(product.id)
+        if len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+        return product
+
+    def clear(self):
+        self.counts.clear()
+        self.total = 0
+        self._recent.clear()
+        self.version += 1
+        cards.clear()
+
+    def load(self, rows):
+        """rows — (категория, количество)"""
+        self.clear()
+        for category, count in rows:
+            self.counts[category] = count
+            self.total += count
+
+    def add(self, product):
+        self.version += 1
+        self.counts[product.category] = self.counts.get(product.category, 0) + 1
+        self.total += 1
+        self.remember(product)
+
+    def remove(self, pid, category=None):
+        self._recent.pop(pid, None)
+        cards.discard(pid)
+        descriptions.discard(pid)
+        if category is None:
+            return None
+        self.version += 1
+        self.counts[category] -= 1
+        self.total -= 1
+        return category
+
+    def get(self, pid):
+        return self._recent.get(pid)
+
+    def set_photos(self, photos):
+        self.version += 1
+        for pid, photo in photos.items():
+            if pid in self._recent:
+                self._recent[pid].photo = photo
+                cards.discard(pid)
+
+    def set_categories(self, changed):
+        self.version += 1
+        for pid, (old, new) in changed.items():
+            self.counts[old] -= 1
+            self.counts[new] = self.counts.get(new, 0) + 1
+            if pid in self._recent:
+                self._recent[pid].category = new
+                cards.discard(pid)
+
+    def count(self, category='all'):
+        if category == 'all':
+            return self.total
+        return self.counts.get(category, 0)
+
+    async def fetch(self, pid):
+        return (await self.fetch_many([pid]) or [None])[0]
+
+    async def fetch_many(self, ids):
+        missing = [pid for pid in ids if pid not in self._recent]
+        if missing:
+            for row in await db.fetch_products_by_id(missing):
+                self.remember(product_from_row(row))
+        return [self._recent[pid] for pid in ids if pid in self._recent]
+
+    async def newest(self, category='all', limit=8):
+        return [self.remember(product_from_row(row)) for row in await db.newest_products(category, limit)]
+
+catalog = SqlCatalog() if CATALOG_MODE == 'sql' else CatalogIndex()
+
+class RenderCache:
+    """LRU-кэш готовых экранов (текст + клавиатура).
+
+    Записи действительны только для той версии каталога, при которой
+    были построены: при смене catalog.version кэш очищается целиком.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.version = None
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if self.version != catalog.version:
+            self._items.clear()
+            self.version = catalog.version
+            return None
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return value
+
+screens = RenderCache()
+
+class CardCache:
+    """LRU-кэш карточек товаров: id → (текст, клавиатура).
+
+    Сбрасывается по одной карточке — CatalogIndex вызывает discard
+    при удалении товара или смене его категории.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, pid):
+        card = self._items.get(pid)
+        if card is not None:
+            self._items.move_to_end(pid)
+        return card
+
+    def put(self, pid, card):
+        self._items[pid] = card
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return card
+
+    def discard(self, pid):
+        self._items.pop(pid, None)
+
+    def clear(self):
+        self._items.clear()
+
+cards = CardCache()
+
+class DescriptionCache:
+    """LRU-кэш описаний товаров; промахи дочитываются из БД одним запросом"""
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def put(self, pid, description):
+        self._items[pid] = description
+        self._items.move_to_end(pid)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    async def get_many(self, ids):
+        found, missing = {}, []
+        for pid in ids:
+            if pid in self._items:
+                self._items.move_to_end(pid)
+                found[pid] = self._items[pid]
+            else:
+                missing.append(pid)
+        if missing:
+            for pid, description in await db.fetch_descriptions(missing):
+                self.put(pid, description)
+                found[pid] = description
+        return found
+
+    async def get(self, pid):
+        return (await self.get_many([pid])).get(pid)
+
+    def discard(self, pid):
+        self._items.pop(pid, None)
+
+descriptions = DescriptionCache()
+
+class ViewCounter:
+    """Просмотры карточек копятся в памяти и пишутся в product_stats пачкой"""
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._views = {}
+        self._task = None
+
+    def hit(self, pid):
+        self._views[pid] = self._views.get(pid, 0) + 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def flush(self):
+        if self._views:
+            views, self._views = self._views, {}
+            await db.add_product_views(views)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+
+views = ViewCounter()
+
+# ===== ФУНКЦИИ =====
+class CategoryClassifier:
+    """Классификатор категорий, собранный один раз из CATEGORIES.
+
+    На каждую категорию — одна скомпилированная регулярка из её ключевых
+    слов. Категории проверяются в порядке CATEGORY_PRIORITY, первая
+    найденная побеждает, как в прежних циклах по словам.
+    """
+
+    def __init__(self, categories, priority, default='🎒 Другое'):
+        self.default = default
+        self.patterns = [
+            (category, re.compile('|'.join(re.escape(word) for word in
+                                           sorted(categories[category], key=len, reverse=True))))
+            for category in priority if categories.get(category)
+        ]
+
+    def classify(self, text):
+        text = text.lower()
+        for category, pattern in self.patterns:
+            if pattern.search(text):
+                return category
+        return self.default
+
+classifier = CategoryClassifier(CATEGORIES, CATEGORY_PRIORITY)
+
+def detect_category(text):
+    """Автоопределение категории"""
+    return classifier.classify(text)
+
+class Product:
+    """Компактная запись товара: только то, что нужно спискам и счётчикам.
+
+    Описание в памяти не держится — карточка берёт его через descriptions.
+    """
+
+    __slots__ = ('id', 'name', 'price', 'price_text', 'category', 'photo')
+
+    def __init__(self, id, name, price, category, photo):
+        self.id = id
+        self.name = name
+        self.price = price  # рубли или None — «Цена в ЛС»
+        self.price_text = price_label(price)
+        self.category = sys.intern(category or '🎒 Другое')
+        self.photo = photo
+
+def price_key(product):
+    return product.price, product.id
+
+def product_from_row(row):
+    """Строка (id, name, price_value, category, photo) → Product"""
+    return Product(*row)
+
+def fetch_products(conn):
+    if CATALOG_MODE == 'sql':
+        return conn.execute('SELECT category, COUNT(*) FROM products GROUP BY category').fetchall()
+    return conn.execute('SELECT id, name, price_value, category, photo FROM products ORDER BY created_at, id').fetchall()
+
+def catalog_version(conn):
+    return int(conn.execute("SELECT value FROM meta WHERE key='catalog_version'").fetchone()[0])
+
+def fetch_snapshot(conn):
+    """Версия и строки каталога из одного читающего снимка БД"""
+    conn.execute('BEGIN')
+    try:
+        return catalog_version(conn), fetch_products(conn)
+    finally:
+        conn.rollback()
+
+def read_snapshot(path, version):
+    """Строки каталога из файла-снимка или None, если его нет или он устарел"""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if snapshot.get('version') != version or snapshot.get('mode') != CATALOG_MODE \
+            or snapshot.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return snapshot['rows']
+
+def write_snapshot(path, version, rows):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': version, 'mode': CATALOG_MODE, 'format': SNAPSHOT_FORMAT, 'rows': rows},
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def load_products():
+    """Загрузка каталога при старте: из снимка, если его версия совпадает с БД, иначе из БД
+    (и снимок сразу переписывается). В режиме sql — только счётчики. Возвращает источник"""
+    version = db.read_sync(catalog_version)
+    rows = read_snapshot(CATALOG_SNAPSHOT, version) if CATALOG_SNAPSHOT else None
+    source = 'снимок'
+    if rows is None:
+        version, rows = db.read_sync(fetch_snapshot)
+        source = 'БД'
+        if CATALOG_SNAPSHOT:
+            write_snapshot(CATALOG_SNAPSHOT, version, rows)
+    catalog.load(rows)
+    snapshots.saved = version
+    return source
+
+async def reload_catalog():
+    """Перечитать каталог из БД после массовых изменений (импорт)"""
+    catalog.load(await db.read(fetch_products))
+    return catalog
+
+class SnapshotWriter:
+    """Фоновая перезапись снимка каталога.
+
+    Раз в interval секунд сверяет версию каталога в БД с сохранённой и,
+    если она изменилась и с прошлой проверки больше не меняется (пачка
+    постов или импорт закончились), пишет новый снимок.
+    """
+
+    def __init__(self, path=CATALOG_SNAPSHOT, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saved = None
+        self._task = None
+
+    def start(self):
+        if self.path:
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        seen = self.saved
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                version = await db.read(catalog_version)
+                if version != self.saved and version == seen:
+                    await self.save()
+                seen = version
+            except Exception:
+                metrics.error('snapshot')
+
+    async def save(self):
+        version, rows = await db.read(fetch_snapshot)
+        if version != self.saved:
+            await asyncio.to_thread(write_snapshot, self.path, version, rows)
+            self.saved = version
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await self.save()
+
+snapshots = SnapshotWriter()
+
+startup = {}  # тайминги старта для баннера
+
+def setup(load_catalog=True):
+    """Открыть БД (схема и миграции) и загрузить каталог — при запуске, а не при импорте модуля"""
+    start = time.monotonic()
+    db.open()
+    startup['db'] = time.monotonic() - start
+    if load_catalog:
+        start = time.monotonic()
+        startup['source'] = load_products()
+        startup['catalog'] = time.monotonic() - start
+
+def format_price(price):
+    price_str = str(price).replace(' ', '')
+    return re.sub(r'(\d)(?=(\d{3})+(?!\d))', r'\1 ', price_str)
+
+# Больше девяти цифр — не цена, а артикул или склеенные размеры из старых подписей;
+# заодно число всегда влезает в INTEGER SQLite
+_PRICE_NUMBER = re.compile(r'\d{1,9}(?!\d)')
+
+def price_number(price):
+    """Цена из текста в целые рубли по первому числу; None, если цены нет («Цена в ЛС») или она неправдоподобна"""
+    match = _PRICE_NUMBER.match(str(price))
+    return int(match.group()) if match else None
+
+@functools.lru_cache(maxsize=65536)
+def price_label(value):
+    """Готовая строка цены для кнопок и карточек: один раз на значение, без регулярок"""
+    return f"{value:,} ₽".replace(',', ' ') if value is not None else "Цена в ЛС"
+
+# ===== РАЗБОР ПОДПИСЕЙ =====
+# Валюта по записи в подписи; цену в каталог берём только рублёвую
+CURRENCIES = {'₽': 'RUB', 'р': 'RUB', 'руб': 'RUB', 'rub': 'RUB', '¥': 'CNY', 'юан': 'CNY', 'cny': 'CNY',
+              '$': 'USD', 'usd': 'USD', '€': 'EUR', 'eur': 'EUR'}
+
+class CaptionParser:
+    """Разбор подписи поста: название, цена, валюта, размеры"""
+
+    # 12990, 12 990, 12.990 — разделители разрядов только внутри строки
+    AMOUNT = r'\d+(?:[ \u00a0\u202f.,]\d{3})*(?!\d)'
+    # То же с первой цифры числа; за ним ищется валюта, откатываться внутрь числа незачем
+    NUMBER = r'[0-9](?<!\d\d)\d*+(?:[ \u00a0\u202f.,]\d{3})*+(?!\d)'
+    RUB = r'₽|[Рр](?:[Уу][Бб]\w*|(?![\w-])\.?)|(?:RUB|rub)\b'
+    FOREIGN = r'[¥$€]|[Юю][Аа][Нн]\w*|(?:CNY|cny|USD|usd|EUR|eur)\b'
+    # 42, 44.5, 40-45, 2, S-XL; число перед группой из трёх цифр — уже цена («Размер 42 12 990₽»)
+    SIZE = (r'\d{1,2}(?:[.,]5)?(?:[-–]\d{2}(?:[.,]5)?)?(?!\d)(?![ \u00a0\u202f]\d{3}(?!\d))'
+            r'|(?i:(?:[2-4]?X[SL]|XXX?L|XX?S|S|M|L)(?:[-–](?:[2-4]?X[SL]|XXX?L|XX?S|S|M|L))?\b|one[ \t]?size)')
+    # Удаляет разделители разрядов: «12 990» → «12990»
+    DIGITS = str.maketrans('', '', ' \u00a0\u202f.,')
+
+    def __init__(self):
+        amount, size = self.AMOUNT, self.SIZE
+        # «Цена: 12 990», «Цена 8990 руб»; сумма в другой валюте здесь не цена.
+        # Шаблон начинается с буквального «ен»: движок ищет его как подстроку, а не перебирает символы классом
+        label = rf'[АаЫы]?+[ \t]*+[:\-–—]?+[ \t]*+(?P<amount>{amount})(?![ \t]*(?:{self.FOREIGN}))'
+        self.label = re.compile(rf'ен(?<=[Цц]ен){label}')
+        self.label_upper = re.compile(rf'ЕН(?<=[Цц]ЕН){label}')
+        # Сумма и валюта после неё за один проход: «12 990₽», «2 990р.», «899¥», «1099 юаней»
+        self.money = re.compile(rf'(?P<amount>{self.NUMBER})[ \t]*+(?:(?P<rub>{self.RUB})|(?P<cur>{self.FOREIGN}))')
+        self.rub = re.compile(rf'(?P<amount>{self.NUMBER})[ \t]*+(?:{self.RUB})')
+        # «$120», «¥1 599»
+        self.prefixed = re.compile(rf'[¥$€][ \t]*(?P<amount>{amount})')
+        # Отдельное число из трёх и более цифр: не артикул (DD1391-100), не размер 44.5
+        self.bare = re.compile(r'[0-9](?<![\w\-/.,]\d)(?:\d{0,2}(?:[ \u00a0\u202f]\d{3})+|\d{2,})(?![\w\-/])')
+        # «Размеры:», «Размеры в наличии», «Size», «EU», «р-р»; за словом — список размеров
+        self.size_word = re.compile(
+            rf'[РрSsEe](?:(?<=[Рр])(?:(?i:азмер)\w*(?:[ \t]+в[ \t]+наличии)?|-[Рр])|(?<=[Ss])(?i:ize)\w*'
+            rf'|(?<=[Ee])(?<![\w][Ee])[Uu]\b)'
+            rf'(?:[ \t]*[:\-–—]?[ \t]*(?P<sizes>(?:{size})(?:[ \t]*[,/;]?[ \t]*(?:{size}))*))?')
+        # «38 39 40 размеры», «42 р-р»: размеры перед словом
+        self.size_run = re.compile(r'(?<![\d.,])\d{2}(?:[.,]5)?(?:[ \t]*[,/]?[ \t]*\d{2}(?:[.,]5)?)*[ \t]*$')
+        self.size_token = re.compile(size)
+
+    def title(self, text):
+        """Первая строка, если она длиннее 5 символов, иначе начало подписи в одну строку"""
+        first = text[:60].partition('\n')[0]
+        return first.strip() if len(first) > 5 else ' '.join(text[:60].split())
+
+    def _number(self, amount):
+        # Обычно разделитель — пробел: replace втрое дешевле translate
+        try:
+            return int(amount.replace(' ', ''))
+        except ValueError:
+            return int(amount.translate(self.DIGITS))
+
+    def price(self, text):
+        """(цена числом, валюта) или (None, None): «Цена: N», рубли, другая валюта, отдельное число"""
+        match = self.label.search(text) if 'ен' in text else None
+        if 'ЕН' in text:
+            upper = self.label_upper.search(text)
+            if upper and (match is None or upper.start() < match.start()):
+                match = upper
+        foreign = None
+        if match is None:
+            match = self.money.search(text)
+            if match and match.lastgroup == 'cur':
+                # Рубли дальше по тексту важнее чужой валюты
+                foreign, match = match, self.rub.search(text, match.end('amount'))
+        if match:
+            return self._number(match.group('amount')), 'RUB'
+        if '$' in text or '¥' in text or '€' in text:
+            prefixed = self.prefixed.search(text)
+            if prefixed and (foreign is None or prefixed.start() < foreign.start()):
+                return self._number(prefixed.group('amount')), CURRENCIES[text[prefixed.start()]]
+        if foreign:
+            mark = foreign.group('cur').lower()
+            return self._number(foreign.group('amount')), CURRENCIES.get(mark) or CURRENCIES[mark[:3]]
+        match = self.bare.search(text)
+        if match:
+            return self._number(match.group()), 'RUB'
+        return None, None
+
+    def sizes(self, text):
+        """Размеры у первого ключевого слова, за которым (или перед которым) они есть"""
+        for match in self.size_word.finditer(text):
+            found = match.group('sizes')
+            if found is None:
+                run = self.size_run.search(text, text.rfind('\n', 0, match.start()) + 1, match.start())
+                if run is None:
+                    continue
+                found = run.group()
+            return [token.replace(',', '.').replace('–', '-').upper() for token in self.size_token.findall(found)]
+        return []
+
+    def parse(self, text):
+        """(название, цена числом или None, валюта или None, размеры) для подписи"""
+        return (self.title(text), *self.price(text), self.sizes(text))
+
+caption_parser = CaptionParser()
+
+def stored_price(price, currency):
+    """Цена для products.price: рубли строкой цифр или «Цена в ЛС»"""
+    return str(price) if price is not None and currency == 'RUB' and price_number(price) is not None else "Цена в ЛС"
+
+def parse_product_data(text, message_id):
+    """Название, цена (текстом, как в products.price) и категория товара из подписи"""
+    title = caption_parser.title(text)
+    return title or f"Товар #{message_id}", stored_price(*caption_parser.price(text)), detect_category(text)
+
+def reparse_prices(conn):
+    """Пересчёт цен всех товаров по сохранённым описаниям после правки парсера.
+
+    Описание хранится обрезанным до 300 символов: если в обрезанном цена
+    не нашлась, старая остаётся. Возвращает (проверено, изменено, секунд).
+    """
+    started = time.perf_counter()
+    parse = caption_parser.price
+    checked, changed = 0, []
+    for pid, description, price in conn.execute(
+            "SELECT id, description, price FROM products WHERE description IS NOT NULL"):
+        checked += 1
+        value, currency = parse(description)
+        new_price = stored_price(value, currency)
+        if new_price != price and (value is not None or len(description) < 300):
+            changed.append((new_price, price_number(new_price), pid))
+    conn.executemany("UPDATE products SET price=?, price_value=? WHERE id=?", changed)
+    return checked, len(changed), time.perf_counter() - started
+
+# ===== FSM =====
+FSM_TTL = float(os.getenv('FSM_TTL_HOURS', '24')) * 3600  # брошенные заказы забываются
+FSM_MAX_ENTRIES = int(os.getenv('FSM_MAX_ENTRIES', '10000'))
+FSM_FLUSH_INTERVAL = 1.0
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в той же SQLite с кэшем в памяти.
+
+    Чтения обслуживает LRU-кэш (в нём же помнится «состояния нет», чтобы не
+    ходить в БД на каждый апдейт), изменения копятся в dirty и раз в
+    FSM_FLUSH_INTERVAL пишутся одной транзакцией. Записи старше FSM_TTL
+    удаляются, в кэше не больше FSM_MAX_ENTRIES ключей.
+    """
+
+    def __init__(self, ttl=FSM_TTL, max_entries=FSM_MAX_ENTRIES, flush_interval=FSM_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()  # key -> [state, data, updated_at]
+        self._dirty = {}
+        self._flusher = None
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    async def _record(self, key):
+        record = self._cache.get(key)
+        if record is not None and time.time() - record[2] < self.ttl:
+            self._cache.move_to_end(key)
+            return record
+        if key in self._dirty:
+            record = list(self._dirty[key])
+        else:
+            row = await db.load_fsm_state(key, time.time() - self.ttl)
+            record = [row[0], json.loads(row[1]) if row[1] else {}, time.time()] if row else [None, {}, time.time()]
+        self._remember(key, record)
+        return record
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _update(self, key, state, data):
+        record = [state, data, time.time()]
+        self._remember(key, record)
+        self._dirty[key] = tuple(record)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state=None):
+        key = self._key(key)
+        record = await self._record(key)
+        self._update(key, state.state if isinstance(state, State) else state, record[1])
+
+    async def get_state(self, key: StorageKey):
+        return (await self._record(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data):
+        key = self._key(key)
+        record = await self._record(key)
+        self._update(key, record[0], dict(data))
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._record(self._key(key)))[1])
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        records, self._dirty = self._dirty, {}
+        try:
+            await db.save_fsm_states(records)
+        except Exception as e:
+            metrics.error('fsm_flush')
+            print(f"❌ FSM: не сохранено {len(records)} состояний: {e}")
+            self._dirty = {**records, **self._dirty}
+
+    async def _flush_loop(self):
+        last_purge = time.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.time() - last_purge > 60:
+                last_purge = time.time()
+                expired = [k for k, r in self._cache.items() if last_purge - r[2] >= self.ttl]
+                for key in expired:
+                    del self._cache[key]
+                await db.purge_fsm_states(last_purge - self.ttl)
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+        await self.flush()
+
+storage = SQLiteStorage()
+dp = Dispatcher(storage=storage)
+
+class OrderLink(StatesGroup):
+    waiting_for_link = State()
+    waiting_for_size = State()
+    waiting_for_comment = State()
+
+# ===== CALLBACK-ДАННЫЕ =====
+CATEGORY_LIST = list(CATEGORIES)
+
+def category_code(category):
+    return 'a' if category == 'all' else str(CATEGORY_LIST.index(category))
+
+def category_from_code(code):
+    """Обратное category_code; ValueError на чужой код (в т.ч. отрицательный номер)"""
+    if code == 'a':
+        return 'all'
+    index = int(code)
+    if not 0 <= index < len(CATEGORY_LIST):
+        raise ValueError(f"неизвестная категория: {code}")
+    return CATEGORY_LIST[index]
+
+class Field:
+    """Тип поля callback_data: как упаковать значение в строку и разобрать обратно"""
+
+    __slots__ = ('encode', 'decode')
+
+    def __init__(self, encode, decode):
+        self.encode = encode
+        self.decode = decode
+
+INT = Field(str, int)
+STR = Field(str, str)
+CATEGORY = Field(category_code, category_from_code)  # номер в CATEGORY_LIST вместо названия с эмодзи
+
+class CallbackCodec:
+    """Компактная callback_data и таблица обработчиков кнопок.
+
+    Формат: <код>[:поле...], код — 1–2 символа. Разбор — один partition и
+    поиск кода в словаре, вместо перебора фильтров F.data.startswith.
+    Последнее поле может содержать ':' (например, время в курсоре страницы).
+    """
+
+    # Кнопки из старых сообщений: полные имена и префиксы вида product_<id>
+    LEGACY = {'catalog': 'c', 'pageinfo': 'i', 'order_link': 'o', 'support': 's', 'back_main': 'm',
+              'admin_products': 'ap', 'admin_back': 'ab', 'admin_stats': 'as', 'admin_orders': 'ao'}
+    LEGACY_PREFIXES = (('product_', 'p'), ('buy_', 'b'), ('del_', 'ad'), ('cat_', 'k'), ('admincat_', 'ac'))
+
+    def __init__(self):
+        self.actions = {}  # код → (обработчик, типы полей, нужен ли state)
+
+    def action(self, code, *fields):
+        """Декоратор: обработчик кнопки с кодом code, поля передаются аргументами"""
+        def register(handler):
+            wants_state = 'state' in inspect.signature(handler).parameters
+            self.actions[code] = (handler, fields, wants_state)
+            return handler
+        return register
+
+    def pack(self, code, *values):
+        fields = self.actions[code][1]
+        return ':'.join([code] + [field.encode(value) for field, value in zip(fields, values)])
+
+    def unpack(self, data):
+        """callback_data → ((обработчик, типы, нужен ли state), аргументы) или (None, None)"""
+        code, _, rest = data.partition(':')
+        entry = self.actions.get(code)
+        if entry is None:
+            return self.unpack_legacy(data)
+        fields = entry[1]
+        values = rest.split(':', len(fields) - 1) if fields else []
+        if len(values) != len(fields):
+            return None, None
+        try:
+            return entry, [field.decode(value) for field, value in zip(fields, values)]
+        except (ValueError, IndexError):
+            return None, None
+
+    def unpack_legacy(self, data):
+        if data in self.LEGACY:
+            return self.actions[self.LEGACY[data]], []
+        try:
+            for prefix, code in self.LEGACY_PREFIXES:
+                if data.startswith(prefix):
+                    value = data[len(prefix):]
+                    if code in ('k', 'ac'):
+                        return (self.actions[code], [value]) if self.known_category(value) else (None, None)
+                    return self.actions[code], [int(value)]
+            if data.startswith('page_'):
+                category, _, page = data[5:].rpartition('_')
+                if self.known_category(category):
+                    return self.actions['g'], [category, int(page)]
+        except ValueError:
+            pass
+        return None, None
+
+    @staticmethod
+    def known_category(name):
+        # категорию из старой кнопки могли переименовать: такая кнопка — просто устаревшая
+        return name == 'all' or name in CATEGORIES
+
+callbacks = CallbackCodec()
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    """Единая точка входа для кнопок: код из callback_data → обработчик из таблицы"""
+    entry, args = callbacks.unpack(callback.data or '')
+    if entry is None:
+        await callback.answer()
+        return
+    handler, _, wants_state = entry
+    start = time.perf_counter()
+    try:
+        if wants_state:
+            await handler(callback, *args, state=state)
+        else:
+            await handler(callback, *args)
+    except Exception:
+        metrics.error(handler.__name__)
+        raise
+    finally:
+        metrics.observe('handler', handler.__name__, time.perf_counter() - start)
+
+# ===== АНТИФЛУД =====
+# Лимиты нажатий на пользователя: класс действия → (нажатий, за секунд)
+THROTTLE_LIMITS = {'nav': (20, 10), 'buy': (5, 60)}
+THROTTLE_CLASSES = {'c': 'nav', 'k': 'nav', 'g': 'nav', 'kp': 'nav', 'p': 'nav', 'b': 'buy',
+                    'sb': 'nav', 'st': 'nav', 'su': 'nav', 'pv': 'nav', 'pb': 'nav'}
+BUY_DEDUP_WINDOW = 30  # повторный «Заказать» на тот же товар за это время не создаёт заказ
+
+class SlidingWindow:
+    """Счётчик «не больше limit событий за period секунд» на ключ.
+
+    Скользящее окно приближается двумя счётчиками — текущего и прошлого
+    окна, поэтому на ключ хранится один кортеж. Записи старше двух окон
+    вычищаются, когда словарь разрастается.
+    """
+
+    def __init__(self, limit, period, maxsize=10000):
+        self.limit = limit
+        self.period = period
+        self.maxsize = maxsize
+        self._counters = {}  # ключ → (номер окна, прошлое окно, текущее окно)
+
+    def hit(self, key):
+        """Учесть событие. False — лимит превышен (событие не засчитывается)"""
+        window, offset = divmod(time.monotonic(), self.period)
+        entry = self._counters.get(key)
+        if entry is None or entry[0] < window - 1:
+            previous, current = 0, 0
+        elif entry[0] < window:
+            previous, current = entry[2], 0
+        else:
+            previous, current = entry[1], entry[2]
+        if previous * (1 - offset / self.period) + current >= self.limit:
+            self._counters[key] = (window, previous, current)
+            return False
+        self._counters[key] = (window, previous, current + 1)
+        if len(self._counters) > self.maxsize:
+            self._counters = {k: e for k, e in self._counters.items() if e[0] >= window - 1}
+        return True
+
+class RecentKeys:
+    """Ключи, виденные за последние ttl секунд (отсечение повторных нажатий)"""
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = {}
+
+    def first(self, key):
+        """True, если ключ не встречался последние ttl секунд"""
+        now = time.monotonic()
+        if self._expires.get(key, 0) > now:
+            return False
+        self._expires[key] = now + self.ttl
+        if len(self._expires) > self.maxsize:
+            self._expires = {k: t for k, t in self._expires.items() if t > now}
+        return True
+
+class Throttle(BaseMiddleware):
+    """Лимит нажатий кнопок на пользователя и класс действия.
+
+    Лишнее нажатие гасится одним answerCallbackQuery — без edit_text,
+    запросов в БД и уведомлений админу. Админ не ограничивается.
+    """
+
+    def __init__(self, limits=THROTTLE_LIMITS):
+        self.windows = {name: SlidingWindow(limit, period) for name, (limit, period) in limits.items()}
+        self.rejected = 0
+
+    async def __call__(self, handler, event, data):
+        action = THROTTLE_CLASSES.get((event.data or '').partition(':')[0])
+        if action and event.from_user.id != ADMIN_ID \
+                and not self.windows[action].hit((event.from_user.id, action)):
+            self.rejected += 1
+            await event.answer("⏳ Слишком часто, подождите пару секунд")
+            return
+        return await handler(event, data)
+
+throttle = Throttle()
+router.callback_query.outer_middleware(throttle)
+buy_taps = RecentKeys(BUY_DEDUP_WINDOW)
+
+# ===== КЛАВИАТУРЫ =====
+def main_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📦 Каталог", callback_data="c")],
+        [InlineKeyboardButton(text="🔗 Заказ по ссылке", callback_data="o")],
+        [InlineKeyboardButton(text="🔔 Подписки на новинки", callback_data="sb")],
+        [InlineKeyboardButton(text="💬 Поддержка", callback_data="s")]
+    ])
+
+def admin_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📦 Управление товарами", callback_data="ap")],
+        [InlineKeyboardButton(text="🛒 Заказы", callback_data="ao")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="as")],
+        [InlineKeyboardButton(text="◀️ Главное", callback_data="m")]
+    ])
+
+async def product_card(p, description=None):
+    """Текст и клавиатура карточки товара (из кэша, пока товар не менялся)"""
+    card = cards.get(p.id)
+    if card:
+        return card
+    if description is None:
+        description = await descriptions.get(p.id) or ''
+    text = f"🛍 {p.name}\n\n{description}\n\n💰 Цена: {p.price_text}\n\n📁 {p.category}"
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Заказать", callback_data=callbacks.pack("b", p.id))],
+        [InlineKeyboardButton(text="📦 Каталог", callback_data="c")]
+    ])
+    return cards.put(p.id, (text, kb))
+
+async def show_screen(callback, text, reply_markup, photo=None):
+    """Показать экран в сообщении с кнопкой.
+
+    Сообщение правится на месте (edit_media для фото, edit_text для текста);
+    удалить и отправить заново приходится, только если меняется тип
+    сообщения: текст → фото или фото → текст.
+    """
+    message = callback.message
+    try:
+        if photo and getattr(message, 'photo', None):
+            await message.edit_media(InputMediaPhoto(media=photo, caption=text), reply_markup=reply_markup)
+            return
+        if not photo and getattr(message, 'text', None) is not None:
+            await message.edit_text(text, reply_markup=reply_markup)
+            return
+    except TelegramBadRequest as e:
+        if 'message is not modified' in str(e):
+            return
+        metrics.error('edit_message')
+    
+    try:
+        await message.delete()
+    except Exception:
+        metrics.error('delete_message')
+    
+    if photo:
+        await bot.send_photo(callback.from_user.id, photo, caption=text, reply_markup=reply_markup)
+    else:
+        await bot.send_message(callback.from_user.id, text, reply_markup=reply_markup)
+
+def catalog_categories():
+    kb = []
+    for cat in CATEGORIES.keys():
+        count = catalog.count(cat)
+        if count > 0:
+            kb.append([InlineKeyboardButton(text=f"{cat} ({count})", callback_data=callbacks.pack("k", cat))])
+    kb.append([InlineKeyboardButton(text="📦 Все товары", callback_data=callbacks.pack("k", "all"))])
+    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="m")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def paginate_products(page=0, category='all'):
+    per_page = 8
+    total = catalog.count(category)
+    end = (page + 1) * per_page
+    page_products = catalog.page(category, page, per_page)
+    
+    kb = []
+    for p in page_products:
+        kb.append([InlineKeyboardButton(
+            text=f"{p.price_text} | {p.name[:30]}",
+            callback_data=callbacks.pack("p", p.id)
+        )])
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=callbacks.pack("g", category, page - 1)))
+    nav.append(InlineKeyboardButton(text=f"{page+1}/{(total-1)//per_page+1}", callback_data="i"))
+    if end < total:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=callbacks.pack("g", category, page + 1)))
+    
+    if nav:
+        kb.append(nav)
+    
+    kb.append(price_controls(category))
+    kb.append([InlineKeyboardButton(text="🔙 Категории", callback_data="c")])
+    return InlineKeyboardMarkup(inline_keyboard=kb), total
+
+def page_callback(category, page, direction, row):
+    """Курсор страницы в callback_data: kp:<категория>:<страница>:<n|p>:<id>:<created_at>"""
+    return callbacks.pack("kp", category, page, direction, row[0], row[3])
+
+async def paginate_products_sql(page=0, category='all', cursor=None, direction='next'):
+    """Страница из БД по курсору (CATALOG_MODE=sql)"""
+    per_page = 8
+    total = catalog.count(category)
+    rows, has_next, first = await db.products_page(category, cursor, direction, per_page)
+    if first:
+        page = 0
+    
+    kb = []
+    for pid, name, price, _ in rows:
+        kb.append([InlineKeyboardButton(
+            text=f"{price_label(price)} | {name[:30]}",
+            callback_data=callbacks.pack("p", pid)
+        )])
+    
+    nav = []
+    if page > 0 and rows:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=page_callback(category, page - 1, 'p', rows[0])))
+    nav.append(InlineKeyboardButton(text=f"{page+1}/{(total-1)//per_page+1}", callback_data="i"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=page_callback(category, page + 1, 'n', rows[-1])))
+    
+    kb.append(nav)
+    kb.append(price_controls(category))
+    kb.append([InlineKeyboardButton(text="🔙 Категории", callback_data="c")])
+    return InlineKeyboardMarkup(inline_keyboard=kb), total
+
+# Бюджеты для фильтра: (от, до) в рублях, None — без границы
+PRICE_BANDS = [
+    (None, None, "Любой бюджет"),
+    (None, 5000, "до 5 000 ₽"),
+    (5000, 15000, "5 000 – 15 000 ₽"),
+    (15000, 30000, "15 000 – 30 000 ₽"),
+    (30000, None, "от 30 000 ₽"),
+]
+
+def price_controls(category, order=None, band=0):
+    """Ряд кнопок сортировки: на странице «новые» order=None"""
+    if order is None:
+        return [InlineKeyboardButton(text="💰 По цене", callback_data=callbacks.pack("pv", category, 'a', 0, 0, 'n', 0, 0)),
+                InlineKeyboardButton(text="🎯 Бюджет", callback_data=callbacks.pack("pb", category, 'a'))]
+    other = 'd' if order == 'a' else 'a'
+    return [InlineKeyboardButton(text="⬇️ Дороже" if other == 'd' else "⬆️ Дешевле",
+                                 callback_data=callbacks.pack("pv", category, other, band, 0, 'n', 0, 0)),
+            InlineKeyboardButton(text="🎯 Бюджет", callback_data=callbacks.pack("pb", category, order)),
+            InlineKeyboardButton(text="🆕 Новые", callback_data=callbacks.pack("k", category))]
+
+def price_page_callback(category, order, band, page, direction, row):
+    """pv:<категория>:<a|d>:<бюджет>:<страница>:<n|p>:<цена>:<id> — курсор (цена, id) для режима sql"""
+    return callbacks.pack("pv", category, order, band, page, direction, row[2], row[0])
+
+async def render_price_page(category, order='a', band=0, page=0, cursor=None, direction='next'):
+    """Страница категории по цене с фильтром бюджета (из кэша, пока каталог не менялся)"""
+    key = ('price', category, order, band, page, cursor, direction)
+    cached = screens.get(key)
+    if cached:
+        return cached
+    per_page = 8
+    low, high, band_name = PRICE_BANDS[band]
+    sort = 'asc' if order == 'a' else 'desc'
+    if CATALOG_MODE == 'sql':
+        rows, has_next, first, total = await db.products_by_price(category, sort, low, high, cursor, direction, per_page)
+        if first:
+            page = 0
+    else:
+        products, total = catalog.price_page(category, sort, low, high, page, per_page)
+        rows = [(p.id, p.name, p.price) for p in products]
+        has_next = (page + 1) * per_page < total
+    
+    kb = []
+    for pid, name, price in rows:
+        kb.append([InlineKeyboardButton(text=f"{price_label(price)} | {name[:30]}", callback_data=callbacks.pack("p", pid))])
+    
+    nav = []
+    if page > 0 and rows:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=price_page_callback(category, order, band, page - 1, 'p', rows[0])))
+    nav.append(InlineKeyboardButton(text=f"{page+1}/{max(total-1, 0)//per_page+1}", callback_data="i"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=price_page_callback(category, order, band, page + 1, 'n', rows[-1])))
+    kb.append(nav)
+    kb.append(price_controls(category, order, band))
+    kb.append([InlineKeyboardButton(text="🔙 Категории", callback_data="c")])
+    
+    cat_name = category if category != 'all' else 'Все товары'
+    text = (f"📦 {cat_name}\n\n"
+            f"{'⬆️ Сначала дешевле' if order == 'a' else '⬇️ Сначала дороже'} · {band_name}\n"
+            f"Товаров с ценой: {total}")
+    return screens.put(key, (text, InlineKeyboardMarkup(inline_keyboard=kb)))
+
+def render_catalog():
+    """Экран выбора категории (из кэша, пока каталог не менялся)"""
+    cached = screens.get('catalog')
+    if cached:
+        return cached
+    text = (f"📦 Каталог POIZON LAB\n\n"
+            f"Всего товаров: {len(catalog)}\n\n"
+            f"Выберите категорию:")
+    return screens.put('catalog', (text, catalog_categories()))
+
+async def render_page(category, page, cursor=None, direction='next'):
+    """Страница категории (из кэша, пока каталог не менялся)"""
+    key = ('page', category, page, cursor, direction)
+    cached = screens.get(key)
+    if cached:
+        return cached
+    if CATALOG_MODE == 'sql':
+        kb, total = await paginate_products_sql(page, category, cursor, direction)
+    else:
+        kb, total = paginate_products(page, category)
+    cat_name = category if category != 'all' else 'Все товары'
+    return screens.put(key, (f"📦 {cat_name}\n\nТоваров: {total}", kb))
+
+# ===== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ =====
+PRIORITY_USER = 0   # ответы покупателям уходят первыми
+PRIORITY_ADMIN = 1  # уведомления админу — после них
+ADMIN_DIGEST_WINDOW = float(os.getenv('ADMIN_DIGEST_WINDOW', '3'))  # 0 — без дайджеста
+
+class TokenBucket:
+    """Ведро токенов: rate сообщений в секунду, всплеск до burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Забрать токен. Возвращает 0 или сколько секунд ждать до следующего"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        return now - self.updated > self.burst / self.rate
+
+class Outbox:
+    """Фоновая отправка сообщений с учётом лимитов Telegram.
+
+    Общий лимит и лимит на чат — ведра токенов; сообщение в «занятый» чат
+    откладывается, не задерживая остальные. На TelegramRetryAfter очередь
+    засыпает на указанное время и повторяет отправку. Уведомления админу,
+    пришедшие за ADMIN_DIGEST_WINDOW секунд, склеиваются в одно сообщение.
+    """
+
+    def __init__(self, global_rate=25, chat_rate=1, chat_burst=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._digest = []
+        self._digest_timer = None
+        self._deferred = {}  # seq → (таймер, сообщение), отложенные из-за лимита чата
+        self._stopping = False
+        self._worker = None
+
+    def send(self, chat_id, text, priority=PRIORITY_USER, **kwargs):
+        """Поставить сообщение в очередь. Возвращает future с отправленным Message"""
+        future = asyncio.get_running_loop().create_future()
+        # ошибка всё равно печатается воркером, а ждать future не обязательно
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queue.put_nowait((priority, next(self._seq), chat_id, text, kwargs, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return future
+
+    def take_global(self):
+        """Токен общего лимита для отправок мимо очереди (рассылка): 0 или сколько секунд ждать"""
+        return self._global.take()
+
+    def notify_admin(self, text):
+        if ADMIN_DIGEST_WINDOW <= 0:
+            return self.send(ADMIN_ID, text, PRIORITY_ADMIN)
+        self._digest.append(text)
+        if self._digest_timer is None:
+            self._digest_timer = asyncio.get_running_loop().call_later(ADMIN_DIGEST_WINDOW, self._flush_digest)
+
+    def _flush_digest(self):
+        texts, self._digest, self._digest_timer = self._digest, [], None
+        if len(texts) == 1:
+            self.send(ADMIN_ID, texts[0], PRIORITY_ADMIN)
+            return
+        chunk = f"📬 Уведомлений: {len(texts)}"
+        for text in texts:
+            if len(chunk) + len(text) + 8 > 4096:
+                self.send(ADMIN_ID, chunk, PRIORITY_ADMIN)
+                chunk = ""
+            chunk += f"\n\n➖➖➖\n\n{text}"
+        self.send(ADMIN_ID, chunk, PRIORITY_ADMIN)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._deliver(loop, item)
+            finally:
+                # stop() ждёт join(): сообщение считается ушедшим, только когда отправка закончилась
+                self._queue.task_done()
+
+    async def _deliver(self, loop, item):
+        priority, seq, chat_id, text, kwargs, future = item
+        # при остановке лимит чата не ждём: отложенное иначе не успеет уйти
+        wait = 0 if self._stopping else self._chat_bucket(chat_id).take()
+        if wait:
+            self._deferred[seq] = (loop.call_later(wait, self._requeue, seq), item)
+            return
+        wait = self._global.take()
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            result = await bot.send_message(chat_id, text, **kwargs)
+        except TelegramRetryAfter as e:
+            print(f"⏳ Flood control: ждём {e.retry_after} c")
+            await asyncio.sleep(e.retry_after)
+            self._queue.put_nowait(item)
+        except Exception as e:
+            metrics.error('outbox')
+            print(f"❌ Не отправлено в {chat_id}: {e}")
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+    def _requeue(self, seq):
+        _, item = self._deferred.pop(seq)
+        self._queue.put_nowait(item)
+
+    async def stop(self, timeout=5):
+        """Дослать накопленное (дайджест, отложенные и очередь) и остановить воркер"""
+        self._stopping = True
+        if self._digest_timer:
+            self._digest_timer.cancel()
+            self._flush_digest()
+        for seq, (handle, _) in list(self._deferred.items()):
+            handle.cancel()
+            self._requeue(seq)
+        if not self._queue.empty() and (self._worker is None or self._worker.done()):
+            self._worker = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Outbox: не успели дослать очередь за {timeout} с, в ней ещё {self._queue.qsize()} сообщений")
+        if self._worker:
+            self._worker.cancel()
+
+outbox = Outbox(global_rate=25 / WORKERS)  # общий лимит Telegram делится между воркерами
+
+# ===== РАССЫЛКА НОВИНОК =====
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))  # сообщений в секунду, запас до ~30/с от лимита Telegram
+BROADCAST_BATCH = 50   # подписчиков в пачке; после каждой пачки прогресс пишется в БД
+BROADCAST_POLL = 5     # секунд между проверками заданий от других воркеров
+BROADCAST_PREVIEW = 5  # сколько новинок перечислять в одном сообщении
+
+def broadcast_message(category, products):
+    """Задание рассылки для новинок одной категории: (category, text, photo, markup)"""
+    if len(products) == 1:
+        p = products[0]
+        text = f"🆕 Новинка в {category}\n\n🛍 {p.name}\n💰 {p.price_text}"
+        kb = [[InlineKeyboardButton(text="👀 Подробнее", callback_data=callbacks.pack("p", p.id))]]
+        photo = p.photo
+    else:
+        text = f"🆕 Новинки в {category}: {len(products)}\n"
+        kb = []
+        for p in products[:BROADCAST_PREVIEW]:
+            text += f"\n🛍 {p.name} — {p.price_text}"
+            kb.append([InlineKeyboardButton(text=p.name[:30], callback_data=callbacks.pack("p", p.id))])
+        kb.append([InlineKeyboardButton(text="📦 Вся категория", callback_data=callbacks.pack("k", category))])
+        photo = None
+    kb.append([InlineKeyboardButton(text="🔕 Отписаться", callback_data=callbacks.pack("su", category))])
+    return category, text, photo, InlineKeyboardMarkup(inline_keyboard=kb).model_dump_json(exclude_none=True)
+
+class Broadcaster:
+    """Рассылка новинок подписчикам категорий.
+
+    Новые товары из канала превращаются в задания (таблица broadcasts),
+    по одному на категорию; сама рассылка идёт в фоне и ingest не ждёт.
+    Подписчики читаются пачками по user_id, отправки пачки стартуют в темпе
+    ведра токенов и выполняются параллельно. После пачки курсор и счётчики
+    пишутся в БД: после перезапуска задание продолжается с места остановки,
+    повторно может уйти не больше одной пачки. Заблокировавшие бота
+    отписываются. Задания ведёт один процесс (при WORKERS > 1 — воркер 0).
+    """
+
+    def __init__(self, rate=BROADCAST_RATE, batch=BROADCAST_BATCH, poll=BROADCAST_POLL):
+        self.bucket = TokenBucket(rate, rate)
+        self.batch = batch
+        self.poll = poll
+        self._wake = asyncio.Event()
+        self._hold_until = 0.0  # после TelegramRetryAfter новые отправки ждут до этого момента
+        self._stopping = False
+        self._task = None
+
+    async def enqueue(self, products):
+        """Поставить рассылку новых товаров (по заданию на категорию)"""
+        by_category = {}
+        for p in products:
+            by_category.setdefault(p.category, []).append(p)
+        await db.create_broadcasts([broadcast_message(category, items) for category, items in by_category.items()])
+        self._wake.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                self._wake.clear()
+                job = await db.next_broadcast()
+                if job:
+                    await self.run(job)
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                metrics.error('broadcast')
+                print(f"❌ Рассылка: {e}")
+                await asyncio.sleep(self.poll)
+
+    async def run(self, job):
+        job_id, category, text, photo, markup, cursor, sent, failed, blocked = job
+        kb = InlineKeyboardMarkup.model_validate_json(markup) if markup else None
+        resumed = cursor > 0
+        start = time.monotonic()
+        delivered = 0
+        while True:
+            if self._stopping:
+                return  # продолжим с cursor после перезапуска
+            users = await db.subscribers_page(category, cursor, self.batch)
+            if not users:
+                break
+            results = await self._send_batch(users, text, photo, kb)
+            gone = [user_id for user_id, result in zip(users, results) if result == 'blocked']
+            delivered += results.count('sent')
+            sent += results.count('sent')
+            failed += results.count('failed')
+            blocked += len(gone)
+            cursor = users[-1]
+            await db.save_broadcast_progress(job_id, cursor, sent, failed, blocked, gone)
+        await db.save_broadcast_progress(job_id, cursor, sent, failed, blocked, done=True)
+        elapsed = time.monotonic() - start
+        if sent or failed or blocked:
+            print(f"📣 Рассылка #{job_id} ({category}): {sent} шт. за {elapsed:.1f} с")
+            outbox.notify_admin(
+                f"📣 Рассылка #{job_id}: {category}{' (после перезапуска)' if resumed else ''}\n\n"
+                f"✅ Доставлено: {sent}\n"
+                f"🚫 Заблокировали бота (отписаны): {blocked}\n"
+                f"❌ Ошибок: {failed}\n"
+                f"⏱ {elapsed:.1f} с, {delivered / elapsed if elapsed else 0:.1f} сообщений/с")
+
+    async def _send_batch(self, users, text, photo, kb):
+        """Отправки стартуют по одной в темпе ведра, а ждут ответа Telegram параллельно.
+
+        Кроме своего ведра каждая отправка берёт токен из общего лимита outbox:
+        рассылка и ответы пользователям вместе не выходят за лимит Telegram.
+        """
+        tasks = []
+        for user_id in users:
+            while True:
+                wait = max(self._hold_until - time.monotonic(), 0) or self.bucket.take()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            wait = outbox.take_global()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = outbox.take_global()
+            tasks.append(asyncio.create_task(self._send(user_id, text, photo, kb)))
+        return await asyncio.gather(*tasks)
+
+    async def _send(self, user_id, text, photo, kb, attempts=3):
+        """'sent', 'blocked' (бот заблокирован или чата нет) или 'failed'"""
+        for _ in range(attempts):
+            try:
+                if photo:
+                    await bot.send_photo(user_id, photo, caption=text, reply_markup=kb)
+                else:
+                    await bot.send_message(user_id, text, reply_markup=kb)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                self._hold_until = max(self._hold_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramBadRequest as e:
+                if 'chat not found' in str(e):
+                    return 'blocked'
+                break
+            except Exception:
+                break
+        metrics.error('broadcast_send')
+        return 'failed'
+
+    async def close(self, timeout=10):
+        """Дождаться текущей пачки и остановиться; незаконченное задание продолжится после перезапуска"""
+        self._stopping = True
+        self._wake.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+
+broadcasts = Broadcaster()
+
+# ===== ПАКЕТНАЯ ЗАПИСЬ ПОСТОВ =====
+INGEST_WINDOW = 1.5  # секунд ждём следующие посты пачки
+INGEST_MAX_BATCH = 50
+
+class IngestBatcher:
+    """Собирает посты в пачки по времени/размеру и пишет каждую одной транзакцией.
+
+    Фото одного альбома (media_group_id) склеиваются в один товар:
+    подпись берётся с того фото, у которого она есть. С broadcast=True
+    новые товары ставятся в рассылку подписчикам категорий.
+    """
+
+    def __init__(self, title, window=INGEST_WINDOW, max_size=INGEST_MAX_BATCH, broadcast=False):
+        self.title = title
+        self.broadcast = broadcast
+        self.window = window
+        self.max_size = max_size
+        self._items = {}
+        self._duplicates = 0
+        self._skipped = {}
+        self._timer = None
+        self._tasks = set()
+
+    def add(self, post_id, text, photo, media_group_id=None, photo_uid=None):
+        key = ('album', media_group_id) if media_group_id else ('post', post_id)
+        item = self._items.get(key)
+        if item is None:
+            self._items[key] = {'post_id': post_id, 'text': text, 'photo': photo, 'photo_uid': photo_uid}
+        elif media_group_id:
+            if text and not item['text']:
+                item['text'] = text
+        else:
+            self._duplicates += 1
+        self._schedule()
+
+    def skip(self, reason):
+        self._skipped[reason] = self._skipped.get(reason, 0) + 1
+        self._schedule()
+
+    def _schedule(self):
+        if len(self._items) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._items and not self._skipped:
+            return
+        batch = (self._items, self._duplicates, self._skipped)
+        self._items, self._duplicates, self._skipped = {}, 0, {}
+        task = asyncio.create_task(self._write(*batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        """Дописать всё накопленное (при остановке бота)"""
+        self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _write(self, items, duplicates, skipped):
+        rows = []
+        for item in items.values():
+            title, price, category = parse_product_data(item['text'], item['post_id'])
+            rows.append((title, item['text'][:300], price, item['photo'], item['post_id'], category,
+                         item['photo_uid'], minhash(item['text'][:300])))
+        try:
+            results = await db.insert_products(rows) if rows else []
+        except Exception as e:
+            metrics.error('ingest')
+            print(f"❌ Ошибка: {e}")
+            outbox.notify_admin(f"❌ Ошибка записи пачки ({len(rows)} шт.): {e}")
+            return
+
+        added = []
+        photos = {}
+        reposts = failed = 0
+        for (title, description, price, photo, post_id, category, *_), result in zip(rows, results):
+            if result is None:
+                failed += 1
+                continue
+            kind, pid = result
+            if kind == 'repost':
+                reposts += 1
+                continue
+            if kind == 'duplicate':
+                duplicates += 1
+                continue
+            if kind == 'photo':
+                photos[pid] = photo
+                print(f"🖼 Фото для импортированного товара {pid} | {title}")
+                continue
+            product = Product(pid, title, price_number(price), category, photo)
+            catalog.add(product)
+            descriptions.put(pid, description)
+            added.append(product)
+            print(f"✅ {category} | {title} | {product.price_text}")
+
+        if photos:
+            catalog.set_photos(photos)
+            catalog_sync.publish('photos', photos)
+        if added:
+            catalog_sync.publish('add', [p.id for p in added])
+            if self.broadcast:
+                try:
+                    await broadcasts.enqueue(added)
+                except Exception as e:
+                    metrics.error('broadcast')
+                    print(f"❌ Рассылка не поставлена: {e}")
+        outbox.notify_admin(self.report(added, duplicates, skipped, reposts, failed, len(photos)))
 
-# ===== КАТЕГОРИИ =====
-CATEGORIES = {
-    '👟 Обувь': ['кроссовки', 'кросс', 'ботинки', 'тапки', 'сланцы', 'slides', 'туфли', 'boots', 'sneakers', 'air force', 'dunk'],
-    '🧥 Верхняя одежда': ['куртка', 'пуховик', 'пальто', 'парка', 'ветровка', 'бомбер', 'jacket', 'coat', 'hoodie', 'худи', 'толстовка', 'свитшот', 'кофта'],
-    '👕 Одежда': ['футболка', 'майка', 'шорты', 'джинсы', 'брюки', 'штаны', 'рубашка', 'shirt', 'pants', 'jeans', 'tshirt', 'tee', 'polo', 'свитер'],
-    '👜 Сумки': ['сумка', 'рюкзак', 'сумочка', 'клатч', 'кошелек', 'портмоне', 'bag', 'backpack', 'wallet', 'crossbody', 'messenger', 'поясная'],
-    '⌚️ Аксессуары': ['часы', 'браслет', 'цепь', 'кольцо', 'серьги', 'очки', 'кепка', 'шапка', 'перчатки', 'ремень', 'носки', 'watch', 'belt', 'cap', 'hat', 'glasses', 'chain', 'подвеска'],
-    '💄 Косметика': ['крем', 'помада', 'тушь', 'духи', 'парфюм', 'маска', 'сыворотка', 'тональ', 'пудра', 'лак', 'лосьон', 'косметика', 'perfume', 'cream', 'serum', 'lipstick', 'блеск'],
-    '🎒 Другое': []
-}
+    def report(self, added, duplicates, skipped, reposts=0, failed=0, photos=0):
+        if len(added) == 1 and not duplicates and not skipped and not reposts and not failed and not photos:
+            p = added[0]
+            return (f"{self.title}\n\n{p.category}\n🛍 {p.name}\n"
+                    f"💰 {p.price_text}\n\n📦 Всего товаров: {len(catalog)}")
+        text = f"{self.title}\n\n✅ Добавлено: {len(added)}\n⚠️ Дубликатов: {duplicates}\n"
+        if reposts:
+            text += f"🔁 Повторов уже известных товаров: {reposts}\n"
+        if photos:
+            text += f"🖼 Фото для товаров из импорта: {photos}\n"
+        if failed:
+            text += f"❌ Не записано из-за ошибки: {failed}\n"
+        for reason, count in skipped.items():
+            text += f"⏭ {reason}: {count}\n"
+        return text + f"\n📦 Всего товаров: {len(catalog)}"
 
-# ===== БАЗА ДАННЫХ =====
-conn = sqlite3.connect('poizon_bot.db', check_same_thread=False)
-cursor = conn.cursor()
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS products (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL,
-    description TEXT,
-    price TEXT,
-    photo TEXT,
-    source TEXT,
-    post_id INTEGER UNIQUE,
-    category TEXT DEFAULT '🎒 Другое',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS orders (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    username TEXT,
-    full_name TEXT,
-    product TEXT,
-    price TEXT,
-    type TEXT,
-    status TEXT DEFAULT 'new',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-''')
-conn.commit()
-
-products_db = []
+channel_batcher = IngestBatcher("✅ НОВЫЙ ТОВАР!", broadcast=True)
+forward_batcher = IngestBatcher("📥 Пересланные посты")
 
-# ===== ФУНКЦИИ =====
-def detect_category(text):
-    """Автоопределение категории"""
-    text_lower = text.lower()
-    
-    for keyword in ['худи', 'hoodie', 'толстовка', 'свитшот', 'куртка', 'пуховик', 'пальто', 'парка', 'ветровка', 'бомбер', 'jacket', 'coat', 'кофта']:
-        if keyword in text_lower:
-            return '🧥 Верхняя одежда'
-    
-    for keyword in ['футболка', 'майка', 'шорты', 'джинсы', 'брюки', 'штаны', 'рубашка', 'shirt', 'pants', 'jeans', 'tshirt', 'tee', 'polo', 'свитер']:
-        if keyword in text_lower:
-            return '👕 Одежда'
-    
-    for keyword in ['кроссовки', 'кросс', 'ботинки', 'тапки', 'сланцы', 'slides', 'туфли', 'boots', 'sneakers', 'air force', 'dunk']:
-        if keyword in text_lower:
-            return '👟 Обувь'
-    
-    for keyword in ['сумка', 'рюкзак', 'сумочка', 'клатч', 'кошелек', 'портмоне', 'bag', 'backpack', 'wallet', 'crossbody', 'messenger', 'поясная']:
-        if keyword in text_lower:
-            return '👜 Сумки'
-    
-    for keyword in ['часы', 'браслет', 'цепь', 'кольцо', 'серьги', 'очки', 'кепка', 'шапка', 'перчатки', 'ремень', 'носки', 'watch', 'belt', 'cap', 'hat', 'glasses', 'chain', 'подвеска']:
-        if keyword in text_lower:
-            return '⌚️ Аксессуары'
-    
-    for keyword in ['крем', 'помада', 'тушь', 'духи', 'парфюм', 'маска', 'сыворотка', 'тональ', 'пудра', 'лак', 'лосьон', 'косметика', 'perfume', 'cream', 'serum', 'lipstick', 'блеск']:
-        if keyword in text_lower:
-            return '💄 Косметика'
-    
-    return '🎒 Другое'
+# ===== ИМПОРТ ЭКСПОРТА TELEGRAM DESKTOP =====
+IMPORT_BATCH = 5000
+_JSON_SKIP = re.compile(r'[\s,]*')
 
-def load_products():
-    global products_db
-    cursor.execute('SELECT * FROM products ORDER BY created_at DESC')
-    products_db = []
-    for row in cursor.fetchall():
-        products_db.append({
-            'id': row[0],
-            'name': row[1],
-            'description': row[2],
-            'price': row[3],
-            'photo': row[4],
-            'source': row[5],
-            'post_id': row[6],
-            'category': row[7] if len(row) > 7 else '🎒 Другое'
-        })
-    return products_db
-
-def save_order(order_data):
-    cursor.execute('''INSERT INTO orders (user_id, username, full_name, product, price, type)
-                      VALUES (?, ?, ?, ?, ?, ?)''', 
-                   (order_data['user_id'], order_data['username'],
-                    order_data['full_name'], order_data['product'], 
-                    order_data['price'], order_data['type']))
-    conn.commit()
-    return cursor.lastrowid
+def iter_export_messages(path, chunk_size=1 << 20):
+    """Потоковое чтение messages из result.json: в памяти один чанк и одно сообщение"""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buf, pos, eof = '', 0, False
 
-def format_price(price):
-    price_str = str(price).replace(' ', '')
-    return re.sub(r'(\d)(?=(\d{3})+(?!\d))', r'\1 ', price_str)
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            return not eof
 
-def parse_product_data(text, message_id):
-    """Универсальная функция парсинга товара"""
-    # Парсинг цены
-    price = "Цена в ЛС"
-    match1 = re.search(r'(\d[\d\s]+?)\s*[₽руб$RUB]', text, re.IGNORECASE)
-    if match1:
-        price = match1.group(1).replace(' ', '')
-    else:
-        match2 = re.search(r'цена[\s\-:]+(\d[\d\s]+)', text, re.IGNORECASE)
-        if match2:
-            price = match2.group(1).replace(' ', '')
-        else:
-            match3 = re.search(r'\b(\d{3,})\b', text)
-            if match3:
-                price = match3.group(1)
-    
-    # Название
-    lines = text.split('\n')
-    if lines and len(lines[0]) > 5:
-        title = lines[0][:60].strip()
-    else:
-        title = text[:60].strip() or f"Товар #{message_id}"
-    
-    # Категория
-    category = detect_category(text)
-    
-    return title, price, category
+        def peek():
+            nonlocal pos
+            while True:
+                pos = _JSON_SKIP.match(buf, pos).end()
+                if pos < len(buf) or not fill():
+                    return buf[pos:pos + 1]
 
-load_products()
+        def decode():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if not fill():
+                        raise
+                    continue
+                # число на краю чанка могло оборваться — дочитываем и пробуем снова
+                if end == len(buf) and not eof and fill():
+                    continue
+                pos = end
+                return value
 
-# ===== FSM =====
-class OrderLink(StatesGroup):
-    waiting_for_link = State()
-    waiting_for_size = State()
-    waiting_for_comment = State()
+        def expect(char):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"{path}: ожидался '{char}' — это не экспорт Telegram Desktop")
+            pos += 1
 
-# ===== КЛАВИАТУРЫ =====
-def main_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 Каталог", callback_data="catalog")],
-        [InlineKeyboardButton(text="🔗 Заказ по ссылке", callback_data="order_link")],
-        [InlineKeyboardButton(text="💬 Поддержка", callback_data="support")]
-    ])
+        expect('{')
+        while peek() != '}':
+            key = decode()
+            expect(':')
+            if key != 'messages':
+                decode()
+                continue
+            expect('[')
+            while peek() != ']':
+                yield decode()
+            expect(']')
 
-def admin_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 Управление товарами", callback_data="admin_products")],
-        [InlineKeyboardButton(text="🛒 Заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="◀️ Главное", callback_data="back_main")]
-    ])
+def export_text(message):
+    """Текст сообщения экспорта: строка или список строк и сущностей"""
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
 
-def catalog_categories():
-    kb = []
-    for cat in CATEGORIES.keys():
-        count = len([p for p in products_db if p.get('category') == cat])
-        if count > 0:
-            kb.append([InlineKeyboardButton(text=f"{cat} ({count})", callback_data=f"cat_{cat}")])
-    kb.append([InlineKeyboardButton(text="📦 Все товары", callback_data="cat_all")])
-    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")])
-    return InlineKeyboardMarkup(inline_keyboard=kb)
+def import_batch(conn, key, rows, last_id):
+    added = conn.executemany('''INSERT OR IGNORE INTO products (name, description, price, price_value, photo, source,
+                                                                post_id, category, created_at)
+                                VALUES (?, ?, ?, ?, NULL, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''', rows).rowcount
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(last_id)))
+    return added
 
-def paginate_products(products, page=0, category='all'):
-    per_page = 8
-    start = page * per_page
-    end = start + per_page
-    
-    filtered = [p for p in products if category == 'all' or p.get('category') == category]
-    page_products = filtered[start:end]
+def import_export(path, batch_size=IMPORT_BATCH, progress=print):
+    """Импорт постов с фото из экспорта канала (result.json) в products.
+
+    Пишет пачками по batch_size в одной транзакции вместе с чекпоинтом
+    (последний id сообщения), поэтому повторный запуск продолжает с места
+    остановки. Синхронная: из бота вызывать через asyncio.to_thread.
+    Фото в экспорте — локальные файлы, а не file_id, поэтому товары
+    приходят без фото; его допишет insert_products, когда тот же пост
+    перешлют боту или он снова придёт из канала.
+    """
+    key = f"import_checkpoint:{os.path.realpath(path)}"
+    row = db.read_sync(lambda conn: conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone())
+    checkpoint = int(row[0]) if row else 0
     
-    kb = []
-    for p in page_products:
-        kb.append([InlineKeyboardButton(
-            text=f"{format_price(p['price'])} ₽ | {p['name'][:30]}",
-            callback_data=f"product_{p['id']}"
-        )])
+    stats = {'read': 0, 'added': 0, 'duplicates': 0, 'skipped': 0, 'resumed_from': checkpoint}
+    rows, last_id = [], checkpoint
+    started = time.perf_counter()
     
-    nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{category}_{page-1}"))
-    nav.append(InlineKeyboardButton(text=f"{page+1}/{(len(filtered)-1)//per_page+1}", callback_data="pageinfo"))
-    if end < len(filtered):
-        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{category}_{page+1}"))
+    def flush():
+        added = db.write_sync(import_batch, key, rows, last_id)
+        stats['added'] += added
+        stats['duplicates'] += len(rows) - added
+        rows.clear()
+        rate = stats['read'] / max(time.perf_counter() - started, 1e-9)
+        progress(f"📥 {stats['read']} сообщений | ✅ {stats['added']} | ⚠️ {stats['duplicates']} | {rate:.0f} сообщ/с")
     
-    if nav:
-        kb.append(nav)
+    for message in iter_export_messages(path):
+        post_id = message.get('id')
+        if not isinstance(post_id, int) or post_id <= checkpoint:
+            continue
+        stats['read'] += 1
+        last_id = max(last_id, post_id)
+        text = export_text(message)
+        # фото без подписи — обычно остальные кадры альбома
+        if message.get('type') != 'message' or 'photo' not in message or not text.strip():
+            stats['skipped'] += 1
+            continue
+        title, price, category = parse_product_data(text, post_id)
+        created_at = message.get('date', '').replace('T', ' ') or None
+        rows.append((title, text[:300], price, price_number(price), CHANNEL_ID, post_id, category, created_at))
+        if len(rows) >= batch_size:
+            flush()
+    flush()
     
-    kb.append([InlineKeyboardButton(text="🔙 Категории", callback_data="catalog")])
-    return InlineKeyboardMarkup(inline_keyboard=kb), len(filtered)
+    stats['seconds'] = time.perf_counter() - started
+    stats['rate'] = stats['read'] / max(stats['seconds'], 1e-9)
+    return stats
 
 # ===== АВТОПАРСЕР НОВЫХ ПОСТОВ =====
 @router.channel_post()
@@ -223,82 +2763,60 @@ async def auto_parse(message: Message):
         channel_username = message.chat.username
         if not channel_username or f"@{channel_username}" != CHANNEL_ID:
             return
-    except:
+    except Exception:
+        metrics.error('auto_parse')
         return
     
     if not message.photo:
         return
     
-    text = message.caption or ""
-    title, price, category = parse_product_data(text, message.message_id)
-    
-    try:
-        cursor.execute('''INSERT OR IGNORE INTO products (name, description, price, photo, source, post_id, category)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (title, text[:300], price, message.photo[-1].file_id, CHANNEL_ID, message.message_id, category))
-        conn.commit()
-        
-        if cursor.rowcount > 0:
-            load_products()
-            await bot.send_message(ADMIN_ID,
-                f"✅ НОВЫЙ ТОВАР!\n\n{category}\n🛍 {title}\n💰 {format_price(price)} ₽\n\n📦 Всего: {len(products_db)}")
-            print(f"✅ {category} | {title} | {price}₽")
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
+    channel_batcher.add(message.message_id, message.caption or "",
+                        message.photo[-1].file_id, message.media_group_id, message.photo[-1].file_unique_id)
 
 # ===== ПАРСЕР ПЕРЕСЛАННЫХ ПОСТОВ (ДЛЯ СТАРЫХ) =====
 @router.message(F.forward_from_chat)
 async def handle_forward(message: Message):
-    """Парсинг старых постов - просто перешлите их боту"""
+    """Парсинг старых постов - просто перешлите их боту (пачки собираются в один отчёт)"""
     if message.from_user.id != ADMIN_ID:
         return
     
     # Проверяем что это из нужного канала
     try:
         if not message.forward_from_chat or not message.forward_from_chat.username:
-            await message.answer("❌ Неизвестный источник")
+            forward_batcher.skip("Неизвестный источник")
             return
         if f"@{message.forward_from_chat.username}" != CHANNEL_ID:
-            await message.answer(f"❌ Это не из канала {CHANNEL_ID}")
+            forward_batcher.skip(f"Не из канала {CHANNEL_ID}")
             return
-    except:
+    except Exception:
+        metrics.error('handle_forward')
         return
     
     if not message.photo:
-        await message.answer("⚠️ Пост без фото, пропущен")
+        forward_batcher.skip("Без фото")
         return
     
-    text = message.caption or ""
     post_id = message.forward_from_message_id or message.message_id
-    title, price, category = parse_product_data(text, post_id)
-    
-    try:
-        cursor.execute('''INSERT OR IGNORE INTO products (name, description, price, photo, source, post_id, category)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (title, text[:300], price, message.photo[-1].file_id, CHANNEL_ID, post_id, category))
-        conn.commit()
-        
-        if cursor.rowcount > 0:
-            load_products()
-            await message.answer(
-                f"✅ Добавлено!\n\n"
-                f"{category}\n"
-                f"🛍 {title}\n"
-                f"💰 {format_price(price)} ₽\n\n"
-                f"📦 Всего товаров: {len(products_db)}"
-            )
-        else:
-            await message.answer("⚠️ Товар уже в базе")
-            
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {e}")
+    forward_batcher.add(post_id, message.caption or "",
+                        message.photo[-1].file_id, message.media_group_id, message.photo[-1].file_unique_id)
 
 # ===== КОМАНДЫ =====
 @router.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, command: CommandObject):
+    # Ссылка из инлайн-поиска: /start p<id> сразу открывает карточку
+    if command.args and command.args.startswith('p') and command.args[1:].isdigit():
+        p = await catalog.fetch(int(command.args[1:]))
+        if p:
+            text, kb = await product_card(p)
+            if p.photo:
+                await message.answer_photo(p.photo, caption=text, reply_markup=kb)
+            else:
+                await message.answer(text, reply_markup=kb)
+            return
+    
     await message.answer(
         f"👋 Добро пожаловать в POIZON LAB!\n\n"
-        f"📦 Товаров: {len(products_db)}\n"
+        f"📦 Товаров: {len(catalog)}\n"
         f"🔄 Канал: {CHANNEL_ID}\n\n"
         f"Выберите действие:",
         reply_markup=main_menu()
@@ -309,12 +2827,11 @@ async def cmd_admin(message: Message):
     if message.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("SELECT COUNT(*) FROM orders WHERE status='new'")
-    new = cursor.fetchone()[0]
+    new = await db.count_orders('new')
     
     await message.answer(
         f"🔐 Админ-панель POIZON LAB\n\n"
-        f"📦 Товаров: {len(products_db)}\n"
+        f"📦 Товаров: {len(catalog)}\n"
         f"🆕 Новых заказов: {new}",
         reply_markup=admin_menu()
     )
@@ -336,82 +2853,197 @@ async def cmd_parse_help(message: Message):
         f"💡 Можно пересылать сразу по 10-20 постов"
     )
 
-# ===== КАТАЛОГ =====
-@router.callback_query(F.data == "catalog")
-async def show_catalog(callback: CallbackQuery):
-    if not products_db:
-        await callback.message.edit_text(
-            f"📦 Каталог пуст\n\n🔄 Ждем посты из {CHANNEL_ID}",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]
-            ])
-        )
+@router.message(Command("import"))
+async def cmd_import(message: Message, command: CommandObject):
+    """Импорт экспорта канала из Telegram Desktop: /import /path/to/result.json"""
+    if message.from_user.id != ADMIN_ID:
         return
     
-    await callback.message.edit_text(
-        f"📦 Каталог POIZON LAB\n\n"
-        f"Всего товаров: {len(products_db)}\n\n"
-        f"Выберите категорию:",
-        reply_markup=catalog_categories()
+    path = (command.args or '').strip()
+    if not path or not os.path.isfile(path):
+        await message.answer("📂 Укажите путь к result.json на сервере:\n/import /data/export/result.json")
+        return
+    
+    await message.answer("⏳ Импорт запущен...")
+    try:
+        stats = await asyncio.to_thread(import_export, path)
+    except Exception as e:
+        metrics.error('import')
+        await message.answer(f"❌ Ошибка импорта: {e}")
+        return
+    await reload_catalog()
+    catalog_sync.publish('reload')
+    
+    await message.answer(
+        f"✅ Импорт завершён\n\n"
+        f"📨 Сообщений: {stats['read']}\n"
+        f"➕ Добавлено: {stats['added']}\n"
+        f"⚠️ Дубликатов: {stats['duplicates']}\n"
+        f"⏭ Пропущено: {stats['skipped']}\n"
+        f"⚡️ {stats['rate']:.0f} сообщ/с за {stats['seconds']:.1f} с\n\n"
+        f"📦 Всего товаров: {len(catalog)}"
     )
 
-@router.callback_query(F.data.startswith("cat_"))
-async def show_category(callback: CallbackQuery):
-    category = callback.data.replace("cat_", "")
-    kb, total = paginate_products(products_db, 0, category)
-    cat_name = category if category != 'all' else 'Все товары'
+@router.message(Command("recategorize"))
+async def cmd_recategorize(message: Message):
+    """Пересчёт категорий всех товаров после правки ключевых слов"""
+    if message.from_user.id != ADMIN_ID:
+        return
     
-    await callback.message.edit_text(
-        f"📦 {cat_name}\n\nТоваров: {total}",
-        reply_markup=kb
+    changed = await db.recategorize_products(classifier.classify)
+    catalog.set_categories(changed)
+    catalog_sync.publish('categories', changed)
+    
+    text = f"🔁 Категории пересчитаны\n\n✏️ Изменено: {len(changed)}\n\n"
+    for cat in CATEGORIES.keys():
+        count = catalog.count(cat)
+        if count > 0:
+            text += f"{cat}: {count}\n"
+    await message.answer(text)
+
+@router.message(Command("reparse"))
+async def cmd_reparse(message: Message):
+    """Пересчёт цен по описаниям после правки парсера подписей"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    checked, changed, seconds = await db.reparse_prices()
+    if changed:
+        await reload_catalog()
+        catalog_sync.publish('reload')
+    
+    await message.answer(
+        f"💰 Цены пересчитаны\n\n"
+        f"🔍 Проверено: {checked}\n"
+        f"✏️ Изменено: {changed}\n"
+        f"⚡️ {checked / max(seconds, 1e-9):.0f} подписей/с за {seconds:.1f} с"
     )
 
-@router.callback_query(F.data.startswith("page_"))
-async def paginate(callback: CallbackQuery):
-    parts = callback.data.split("_")
-    page = int(parts[-1])
-    category = "_".join(parts[1:-1])
-    kb, total = paginate_products(products_db, page, category)
-    cat_name = category if category != 'all' else 'Все товары'
+@router.message(Command("dedup"))
+async def cmd_dedup(message: Message):
+    """Поиск повторов по всему каталогу — после импорта или пересылки старых постов"""
+    if message.from_user.id != ADMIN_ID:
+        return
     
-    await callback.message.edit_text(
-        f"📦 {cat_name}\n\nТоваров: {total}",
-        reply_markup=kb
+    await message.answer("🔍 Ищу повторы...")
+    missing = await db.products_without_fingerprint()
+    signatures = await asyncio.to_thread(lambda: [(pid, minhash(text or '')) for pid, text in missing])
+    for i in range(0, len(signatures), 5000):
+        await db.store_fingerprints(signatures[i:i + 5000])
+    
+    duplicates = await db.duplicate_products()
+    for i in range(0, len(duplicates), 5000):
+        await db.delete_products(duplicates[i:i + 5000])
+    if duplicates:
+        await reload_catalog()
+        catalog_sync.publish('reload')
+    
+    await message.answer(
+        f"🧹 Повторы\n\n"
+        f"🧬 Новых отпечатков: {len(signatures)}\n"
+        f"🔁 Удалено повторов: {len(duplicates)}\n\n"
+        f"📦 Всего товаров: {len(catalog)}"
     )
 
-@router.callback_query(F.data == "pageinfo")
+@router.message(Command("perf"))
+async def cmd_perf(message: Message):
+    """Задержки обработчиков, SQL и Bot API с момента запуска"""
+    if message.from_user.id != ADMIN_ID:
+        return
+    
+    text = "⏱ Производительность (кол-во | p50 / p95 / p99)\n"
+    stats = metrics
+    if metrics.shared:
+        # свои метрики плюс сохранённые остальными воркерами (не старше METRICS_SYNC секунд)
+        stats = Metrics()
+        stats.merge(metrics.dump())
+        workers = await asyncio.to_thread(metrics.workers)
+        for _, state in workers:
+            stats.merge(state)
+        text += f"👷 Воркеров в сумме: {len(workers) + 1}\n"
+    for kind, title in (('handler', "🧩 Обработчики"), ('db', "🗄 SQL"), ('api', "📡 Bot API")):
+        lines = stats.summary(kind)
+        if lines:
+            text += f"\n{title}:\n" + "\n".join(lines) + "\n"
+    errors = stats.error_counts()
+    if errors:
+        text += "\n❗️ Ошибки:\n" + "\n".join(f"{where}: {n}" for where, n in errors.items())
+    await message.answer(text[:4096])
+
+# ===== КАТАЛОГ =====
+@callbacks.action("c")
+async def show_catalog(callback: CallbackQuery):
+    if not catalog:
+        await show_screen(
+            callback,
+            f"📦 Каталог пуст\n\n🔄 Ждем посты из {CHANNEL_ID}",
+            InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="◀️ Назад", callback_data="m")]
+            ])
+        )
+        return
+    
+    text, kb = render_catalog()
+    await show_screen(callback, text, kb)
+
+@callbacks.action("k", CATEGORY)
+async def show_category(callback: CallbackQuery, category):
+    text, kb = await render_page(category, 0)
+    await callback.message.edit_text(text, reply_markup=kb)
+
+@callbacks.action("g", CATEGORY, INT)
+async def paginate(callback: CallbackQuery, category, page):
+    if CATALOG_MODE == 'sql':
+        page = 0  # без курсора в режиме sql — с начала
+    text, kb = await render_page(category, page)
+    await callback.message.edit_text(text, reply_markup=kb)
+
+@callbacks.action("kp", CATEGORY, INT, STR, INT, STR)
+async def paginate_keyset(callback: CallbackQuery, category, page, direction, pid, created_at):
+    direction = 'next' if direction == 'n' else 'prev'
+    text, kb = await render_page(category, page, (created_at, pid), direction)
+    await callback.message.edit_text(text, reply_markup=kb)
+
+@callbacks.action("pv", CATEGORY, STR, INT, INT, STR, INT, INT)
+async def show_by_price(callback: CallbackQuery, category, order, band, page, direction, price, pid):
+    if order not in ('a', 'd') or not 0 <= band < len(PRICE_BANDS):
+        order, band = 'a', 0
+    cursor = (price, pid) if pid else None  # id 0 — без курсора, с начала
+    if CATALOG_MODE == 'sql' and not cursor:
+        page = 0
+    text, kb = await render_price_page(category, order, band, page, cursor, 'next' if direction == 'n' else 'prev')
+    await callback.message.edit_text(text, reply_markup=kb)
+
+@callbacks.action("pb", CATEGORY, STR)
+async def pick_price_band(callback: CallbackQuery, category, order):
+    kb = [[InlineKeyboardButton(text=name, callback_data=callbacks.pack("pv", category, order, band, 0, 'n', 0, 0))]
+          for band, (_, _, name) in enumerate(PRICE_BANDS)]
+    kb.append([InlineKeyboardButton(text="🔙 Назад", callback_data=callbacks.pack("k", category))])
+    await callback.message.edit_text("🎯 Выберите бюджет:", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+@callbacks.action("i")
 async def pageinfo(callback: CallbackQuery):
     await callback.answer()
 
-@router.callback_query(F.data.startswith("product_"))
-async def show_product(callback: CallbackQuery):
-    pid = int(callback.data.split("_")[1])
-    p = next((x for x in products_db if x['id'] == pid), None)
+@callbacks.action("p", INT)
+async def show_product(callback: CallbackQuery, pid):
+    p = await catalog.fetch(pid)
     
     if not p:
         await callback.answer("❌ Товар не найден", show_alert=True)
         return
     
-    text = f"🛍 {p['name']}\n\n{p['description']}\n\n💰 Цена: {format_price(p['price'])} ₽\n\n📁 {p.get('category', '🎒 Другое')}"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Заказать", callback_data=f"buy_{pid}")],
-        [InlineKeyboardButton(text="📦 Каталог", callback_data="catalog")]
-    ])
-    
-    try:
-        await callback.message.delete()
-    except:
-        pass
-    
-    if p.get('photo'):
-        await bot.send_photo(callback.from_user.id, p['photo'], caption=text, reply_markup=kb)
-    else:
-        await bot.send_message(callback.from_user.id, text, reply_markup=kb)
+    text, kb = await product_card(p)
+    views.hit(pid)
+    await show_screen(callback, text, kb, p.photo)
 
-@router.callback_query(F.data.startswith("buy_"))
-async def buy(callback: CallbackQuery):
-    pid = int(callback.data.split("_")[1])
-    p = next((x for x in products_db if x['id'] == pid), None)
+@callbacks.action("b", INT)
+async def buy(callback: CallbackQuery, pid):
+    if not buy_taps.first((callback.from_user.id, pid)):
+        await callback.answer("✅ Заказ уже принят, менеджер скоро свяжется", show_alert=True)
+        return
+    
+    p = await catalog.fetch(pid)
     
     if not p:
         await callback.answer("❌ Товар удален", show_alert=True)
@@ -421,81 +3053,194 @@ async def buy(callback: CallbackQuery):
         'user_id': callback.from_user.id,
         'username': callback.from_user.username or "no_username",
         'full_name': callback.from_user.full_name,
-        'product': p['name'],
-        'price': p['price'],
-        'type': 'catalog'
+        'product': p.name,
+        'price': p.price if p.price is not None else p.price_text,
+        'type': 'catalog',
+        'product_id': pid
     }
     
-    order_id = save_order(order_data)
+    order_id = await db.save_order(order_data)
     
-    await bot.send_message(ADMIN_ID,
+    outbox.notify_admin(
         f"🔔 НОВЫЙ ЗАКАЗ #{order_id}\n\n"
         f"👤 {order_data['full_name']}\n"
         f"📱 @{order_data['username']}\n"
         f"🆔 {order_data['user_id']}\n\n"
-        f"🛍 {p['name']}\n"
-        f"💰 {format_price(p['price'])} ₽")
-    
-    try:
-        await callback.message.delete()
-    except:
-        pass
+        f"🛍 {p.name}\n"
+        f"💰 {p.price_text}")
     
-    await bot.send_message(
-        callback.from_user.id,
+    # Подтверждение — в ту же карточку, фото товара остаётся
+    await show_screen(
+        callback,
         f"✅ Заказ #{order_id} принят!\n\n"
-        f"🛍 {p['name']}\n"
-        f"💰 {format_price(p['price'])} ₽\n\n"
+        f"🛍 {p.name}\n"
+        f"💰 {p.price_text}\n\n"
         f"⏳ Скоро с вами свяжется менеджер!",
-        reply_markup=main_menu()
+        main_menu(),
+        p.photo
     )
     
     await callback.answer("✅ Заказ оформлен!", show_alert=True)
 
+# ===== ПОИСК =====
+SEARCH_CACHE_TTL = 60  # секунд
+SEARCH_CACHE_SIZE = 512
+
+class SearchCache:
+    """Короткоживущий кэш результатов поиска: запрос → id товаров"""
+
+    def __init__(self, ttl=SEARCH_CACHE_TTL, maxsize=SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, query):
+        item = self._items.get(query)
+        if item is None:
+            return None
+        ids, expires, version = item
+        if expires < time.monotonic() or version != catalog.version:
+            del self._items[query]
+            return None
+        self._items.move_to_end(query)
+        return ids
+
+    def put(self, query, ids):
+        self._items[query] = (ids, time.monotonic() + self.ttl, catalog.version)
+        self._items.move_to_end(query)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+search_cache = SearchCache()
+
+def fts_query(text):
+    """Запрос пользователя → выражение FTS5: каждое слово как префикс"""
+    words = re.findall(r'\w+', text.lower())[:8]
+    return ' '.join(f'"{w}"*' for w in words)
+
+async def search(text, limit=20):
+    query = fts_query(text)
+    if not query:
+        return []
+    ids = search_cache.get(query)
+    if ids is None:
+        ids = await db.search_products(query, limit)
+        search_cache.put(query, ids)
+    return await catalog.fetch_many(ids)
+
+@router.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject):
+    if not command.args:
+        await message.answer("🔍 Напишите, что ищете: /search nike dunk\n\n"
+                             "💡 Или в любом чате: @бот и запрос")
+        return
+    
+    results = await search(command.args, 10)
+    if not results:
+        await message.answer("🔍 Ничего не нашлось", reply_markup=main_menu())
+        return
+    
+    kb = [[InlineKeyboardButton(text=f"{p.price_text} | {p.name[:30]}",
+                                callback_data=callbacks.pack("p", p.id))] for p in results]
+    kb.append([InlineKeyboardButton(text="📦 Каталог", callback_data="c")])
+    await message.answer(f"🔍 {command.args}\n\nНайдено: {len(results)}",
+                         reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+@router.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    products = await search(inline_query.query) if inline_query.query.strip() else await catalog.newest('all', 20)
+    me = await bot.me()
+    
+    results = []
+    texts = await descriptions.get_many([p.id for p in products])
+    for p in products:
+        text, _ = await product_card(p, texts.get(p.id) or '')
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Заказать", url=f"https://t.me/{me.username}?start=p{p.id}")]
+        ])
+        if p.photo:
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(p.id), photo_file_id=p.photo, title=p.name,
+                caption=text[:1024], reply_markup=kb))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=str(p.id), title=p.name, description=p.price_text,
+                input_message_content=InputTextMessageContent(message_text=text), reply_markup=kb))
+    
+    await inline_query.answer(results, cache_time=30)
+
+# ===== ПОДПИСКИ =====
+async def render_subscriptions(user_id):
+    subscribed = await db.subscriptions(user_id)
+    kb = []
+    for cat in CATEGORIES:
+        on = cat in subscribed
+        kb.append([InlineKeyboardButton(text=f"{'✅' if on else '➕'} {cat}",
+                                        callback_data=callbacks.pack("st", cat, 0 if on else 1))])
+    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="m")])
+    text = ("🔔 Подписки на новинки\n\n"
+            "Отметьте категории — пришлём новые товары, как только они появятся в канале.\n\n"
+            f"Подписок: {len(subscribed)}")
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+@callbacks.action("sb")
+async def show_subscriptions(callback: CallbackQuery):
+    text, kb = await render_subscriptions(callback.from_user.id)
+    await show_screen(callback, text, kb)
+
+@callbacks.action("st", CATEGORY, INT)
+async def set_subscription(callback: CallbackQuery, category, subscribed):
+    await db.set_subscription(callback.from_user.id, category, bool(subscribed))
+    await callback.answer("🔔 Подписка оформлена" if subscribed else "🔕 Подписка отменена")
+    text, kb = await render_subscriptions(callback.from_user.id)
+    await show_screen(callback, text, kb)
+
+@callbacks.action("su", CATEGORY)
+async def unsubscribe(callback: CallbackQuery, category):
+    """Кнопка под сообщением рассылки: отписка без смены экрана"""
+    await db.set_subscription(callback.from_user.id, category, False)
+    await callback.answer(f"🔕 Больше не пришлём новинки {category}", show_alert=True)
+
 # ===== АДМИН УПРАВЛЕНИЕ =====
-@router.callback_query(F.data == "admin_products")
+@callbacks.action("ap")
 async def admin_products(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return
     
     kb = []
     for cat in CATEGORIES.keys():
-        count = len([p for p in products_db if p.get('category') == cat])
-        kb.append([InlineKeyboardButton(text=f"{cat} ({count})", callback_data=f"admincat_{cat}")])
-    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")])
+        count = catalog.count(cat)
+        kb.append([InlineKeyboardButton(text=f"{cat} ({count})", callback_data=callbacks.pack("ac", cat))])
+    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="ab")])
     
     await callback.message.edit_text(
         "📦 Управление товарами\n\nВыберите категорию:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=kb)
     )
 
-@router.callback_query(F.data.startswith("admincat_"))
-async def admin_category(callback: CallbackQuery):
+@callbacks.action("ac", CATEGORY)
+async def admin_category(callback: CallbackQuery, category):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    category = callback.data.replace("admincat_", "")
-    products = [p for p in products_db if p.get('category') == category]
-    
     kb = []
-    for p in products[:15]:
-        kb.append([InlineKeyboardButton(text=f"❌ {p['name'][:30]}", callback_data=f"del_{p['id']}")])
-    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_products")])
+    for p in await catalog.newest(category, 15):
+        kb.append([InlineKeyboardButton(text=f"❌ {p.name[:30]}", callback_data=callbacks.pack("ad", p.id))])
+    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="ap")])
     
     await callback.message.edit_text(
-        f"📦 {category}\n\nТоваров: {len(products)}\n\nНажмите ❌ для удаления:",
+        f"📦 {category}\n\nТоваров: {catalog.count(category)}\n\nНажмите ❌ для удаления:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=kb)
     )
 
-@router.callback_query(F.data.startswith("del_"))
-async def delete_product(callback: CallbackQuery):
+@callbacks.action("ad", INT)
+async def delete_product(callback: CallbackQuery, pid):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    pid = int(callback.data.split("_")[1])
-    cursor.execute("DELETE FROM products WHERE id=?", (pid,))
-    conn.commit()
-    load_products()
+    category = await db.delete_product(pid)
+    catalog.remove(pid, category)
+    catalog_sync.publish('remove', (pid, category))
     
     await callback.answer("✅ Товар удален!", show_alert=True)
     await callback.message.edit_text(
@@ -503,68 +3248,215 @@ async def delete_product(callback: CallbackQuery):
         reply_markup=admin_menu()
     )
 
-@router.callback_query(F.data == "admin_back")
+@callbacks.action("ab")
 async def admin_back(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("SELECT COUNT(*) FROM orders WHERE status='new'")
-    new = cursor.fetchone()[0]
+    new = await db.count_orders('new')
     
     await callback.message.edit_text(
         f"🔐 Админ-панель POIZON LAB\n\n"
-        f"📦 Товаров: {len(products_db)}\n"
+        f"📦 Товаров: {len(catalog)}\n"
         f"🆕 Новых заказов: {new}",
         reply_markup=admin_menu()
     )
 
-@router.callback_query(F.data == "admin_stats")
+@callbacks.action("as")
 async def admin_stats(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("SELECT COUNT(*) FROM orders")
-    total = cursor.fetchone()[0]
+    await views.flush()
+    report = await db.order_report()
+    total = sum(count for _, count in report['types'])
     
     stats_text = f"📊 Статистика POIZON LAB\n\n"
-    stats_text += f"📦 Всего товаров: {len(products_db)}\n"
+    stats_text += f"📦 Всего товаров: {len(catalog)}\n"
     stats_text += f"🛒 Всего заказов: {total}\n"
     stats_text += f"📱 Канал: {CHANNEL_ID}\n\n"
+    
+    types = dict(report['types'])
+    stats_text += f"📦 Из каталога: {types.get('catalog', 0)}\n"
+    stats_text += f"🔗 По ссылке: {types.get('link', 0)}\n\n"
+    
+    if report['statuses']:
+        stats_text += "По статусам:\n"
+        for status, count in report['statuses']:
+            stats_text += f"{status}: {count}\n"
+        stats_text += "\n"
+    
+    if report['days']:
+        stats_text += "Заказы по дням:\n"
+        for day, count in report['days']:
+            stats_text += f"{day}: {count}\n"
+        stats_text += "\n"
+    
+    if report['products']:
+        stats_text += "Топ товаров (заказы / просмотры):\n"
+        top = {p.id: p for p in await catalog.fetch_many([row[0] for row in report['products']])}
+        for pid, product_views, orders in report['products']:
+            p = top.get(pid)
+            name = p.name[:25] if p else f"#{pid} (удалён)"
+            conversion = f"{orders / product_views:.0%}" if product_views else "—"
+            stats_text += f"{name}: {orders} / {product_views} ({conversion})\n"
+        stats_text += "\n"
+    
     stats_text += "Товары по категориям:\n"
     
     for cat in CATEGORIES.keys():
-        count = len([p for p in products_db if p.get('category') == cat])
+        count = catalog.count(cat)
         if count > 0:
             stats_text += f"{cat}: {count}\n"
     
     await callback.message.edit_text(stats_text, reply_markup=admin_menu())
 
-@router.callback_query(F.data == "admin_orders")
+# ===== ОЧЕРЕДЬ ЗАКАЗОВ =====
+ORDER_STATUSES = {'new': '🆕 Новый', 'confirmed': '✅ Подтверждён', 'paid': '💳 Оплачен',
+                  'shipped': '🚚 Отправлен', 'cancelled': '❌ Отменён'}
+ORDER_FLOW = {'new': 'confirmed', 'confirmed': 'paid', 'paid': 'shipped'}  # следующий шаг по кнопке
+ORDER_TYPES = {'catalog': '📦 Каталог', 'link': '🔗 Ссылка'}
+ORDERS_PER_PAGE = 8
+# Что пишем покупателю при смене статуса
+ORDER_NOTICES = {
+    'confirmed': "✅ Заказ #{id} подтверждён! Менеджер свяжется с вами для оплаты",
+    'paid': "💳 Оплата заказа #{id} получена",
+    'shipped': "🚚 Заказ #{id} отправлен!",
+    'cancelled': "❌ Заказ #{id} отменён. Вопросы — в поддержку",
+}
+
+def order_price(price):
+    return f"{format_price(price)} ₽" if str(price).isdigit() else str(price)
+
+def can_move_order(current, status):
+    """Разрешён ли переход: следующий шаг по ORDER_FLOW или отмена до отправки"""
+    return ORDER_FLOW.get(current) == status or (status == 'cancelled' and current in ORDER_FLOW)
+
+def order_queue_callback(status, order_type, page=0, direction='n', cursor=0):
+    """Страница очереди: oq:<статус>:<тип|a>:<страница>:<n|p>:<id или 0>"""
+    return callbacks.pack("oq", status, order_type or 'a', page, direction, cursor)
+
+async def render_order_queue(status, order_type=None, page=0, cursor=None, direction='next'):
+    rows, has_next, first = await db.orders_page(status, order_type, cursor, direction, ORDERS_PER_PAGE)
+    if first:
+        page = 0
+    total = await db.count_orders(status, order_type)
+    
+    kb = [[InlineKeyboardButton(text=("• " if (order_type or 'a') == code else "") + label,
+                                callback_data=order_queue_callback(status, code))
+           for code, label in [('a', 'Все')] + list(ORDER_TYPES.items())]]
+    for order_id, username, product, price, _ in rows:
+        kb.append([InlineKeyboardButton(
+            text=f"#{order_id} | {order_price(price)} | {product[:25]}",
+            callback_data=callbacks.pack("od", order_id)
+        )])
+    
+    nav = []
+    if page > 0 and rows:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=order_queue_callback(status, order_type, page - 1, 'p', rows[0][0])))
+    nav.append(InlineKeyboardButton(text=f"{page+1}/{max(total-1, 0)//ORDERS_PER_PAGE+1}", callback_data="i"))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=order_queue_callback(status, order_type, page + 1, 'n', rows[-1][0])))
+    kb.append(nav)
+    kb.append([InlineKeyboardButton(text="◀️ Статусы", callback_data="ao")])
+    
+    type_name = ORDER_TYPES.get(order_type, 'Все типы')
+    text = f"🛒 Заказы: {ORDER_STATUSES.get(status, status)}\n{type_name}\n\nВсего: {total}"
+    if not rows:
+        text += "\n\nЗаказов нет"
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+def order_card(order):
+    order_id, user_id, username, full_name, product, price, order_type, status, created_at = order
+    text = (f"🆔 Заказ #{order_id}\n\n"
+            f"👤 {full_name}\n"
+            f"📱 @{username}\n"
+            f"🆔 {user_id}\n\n"
+            f"🛍 {product}\n"
+            f"💰 {order_price(price)}\n"
+            f"{ORDER_TYPES.get(order_type, order_type)}\n"
+            f"🕐 {created_at}\n\n"
+            f"Статус: {ORDER_STATUSES.get(status, status)}")
+    kb = []
+    if status in ORDER_FLOW:
+        following = ORDER_FLOW[status]
+        kb.append([InlineKeyboardButton(text=f"➡️ {ORDER_STATUSES[following]}",
+                                        callback_data=callbacks.pack("os", order_id, status, following))])
+        kb.append([InlineKeyboardButton(text="❌ Отменить",
+                                        callback_data=callbacks.pack("os", order_id, status, 'cancelled'))])
+    kb.append([InlineKeyboardButton(text="◀️ К очереди", callback_data=order_queue_callback(status, None))])
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+@callbacks.action("ao")
 async def admin_orders(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
         return
     
-    cursor.execute("SELECT * FROM orders ORDER BY id DESC LIMIT 10")
-    orders = cursor.fetchall()
+    counts = await db.order_status_counts()
+    kb = []
+    for status, label in ORDER_STATUSES.items():
+        kb.append([InlineKeyboardButton(text=f"{label} ({counts.get(status, 0)})",
+                                        callback_data=order_queue_callback(status, None))])
+    kb.append([InlineKeyboardButton(text="◀️ Назад", callback_data="ab")])
+    
+    await callback.message.edit_text(
+        f"🛒 Заказы\n\nВсего: {sum(counts.values())}\n\nВыберите статус:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb)
+    )
+
+@callbacks.action("oq", STR, STR, INT, STR, INT)
+async def admin_order_queue(callback: CallbackQuery, status, order_type, page, direction, cursor):
+    if callback.from_user.id != ADMIN_ID:
+        return
+    
+    text, kb = await render_order_queue(status, None if order_type == 'a' else order_type,
+                                        page, cursor or None, 'next' if direction == 'n' else 'prev')
+    await show_screen(callback, text, kb)
+
+@callbacks.action("od", INT)
+async def admin_order(callback: CallbackQuery, order_id):
+    if callback.from_user.id != ADMIN_ID:
+        return
     
-    if not orders:
-        await callback.message.edit_text("📦 Заказов пока нет", reply_markup=admin_menu())
+    order = await db.get_order(order_id)
+    if not order:
+        await callback.answer("❌ Заказ не найден", show_alert=True)
+        return
+    text, kb = order_card(order)
+    await show_screen(callback, text, kb)
+
+@callbacks.action("os", INT, STR, STR)
+async def admin_order_status(callback: CallbackQuery, order_id, expected, status):
+    if callback.from_user.id != ADMIN_ID:
         return
     
-    text = "📦 Последние 10 заказов:\n\n"
-    for o in orders:
-        text += f"🆔 #{o[0]} | @{o[2]}\n {o[4][:30]}\n 💰 {o[5]} | {o[7]}\n\n"
+    # expected — статус, который админ видел на экране: два нажатия подряд
+    # или устаревшая карточка не сдвинут заказ дальше, чем он хотел
+    moved = can_move_order(expected, status) and await db.set_order_status(order_id, status, expected)
+    if moved:
+        await callback.answer(ORDER_STATUSES[status])
+    else:
+        await callback.answer("⚠️ Статус заказа уже изменился", show_alert=True)
     
-    await callback.message.edit_text(text, reply_markup=admin_menu())
+    order = await db.get_order(order_id)
+    if not order:
+        return
+    if moved and status in ORDER_NOTICES:
+        outbox.send(order[1], ORDER_NOTICES[status].format(id=order_id))
+    text, kb = order_card(order)
+    await show_screen(callback, text, kb)
 
 # ===== ЗАКАЗ ПО ССЫЛКЕ =====
-@router.callback_query(F.data == "order_link")
+@callbacks.action("o")
 async def order_link(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    await show_screen(
+        callback,
         "🔗 Заказ по ссылке\n\n"
         "Отправьте ссылку на товар с сайта POIZON:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="m")]
         ])
     )
     await state.set_state(OrderLink.waiting_for_link)
@@ -594,9 +3486,9 @@ async def comment(message: Message, state: FSMContext):
         'type': 'link'
     }
     
-    order_id = save_order(order_data)
+    order_id = await db.save_order(order_data)
     
-    await bot.send_message(ADMIN_ID,
+    outbox.notify_admin(
         f"🔔 НОВЫЙ ЗАКАЗ ПО ССЫЛКЕ #{order_id}\n\n"
         f"👤 {order_data['full_name']}\n"
         f"📱 @{order_data['username']}\n"
@@ -614,41 +3506,411 @@ async def comment(message: Message, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(F.data == "support")
+@callbacks.action("s")
 async def support(callback: CallbackQuery):
     try:
         admin_chat = await bot.get_chat(ADMIN_ID)
         admin_username = admin_chat.username if admin_chat.username else "admin"
-    except:
+    except Exception:
+        metrics.error('support')
         admin_username = "admin"
     
-    await callback.message.edit_text(
+    await show_screen(
+        callback,
         f"💬 Техподдержка POIZON LAB\n\n"
         f"📞 Менеджер: @{admin_username}\n"
         f"⏰ Время работы: 24/7\n"
         f"⚡️ Среднее время ответа: 5 минут",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]
+        InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="◀️ Назад", callback_data="m")]
         ])
     )
 
-@router.callback_query(F.data == "back_main")
+@callbacks.action("m")
 async def back(callback: CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text("🏠 Главное меню:", reply_markup=main_menu())
+    await show_screen(callback, "🏠 Главное меню:", main_menu())
 
-# ===== ЗАПУСК =====
-async def main():
+# ===== WEBHOOK =====
+class WebhookServer:
+    """Приём апдейтов по HTTP.
+
+    Запрос проверяется по секрету, апдейт обрабатывается отдельной задачей,
+    а ответ Telegram уходит сразу. Одновременно обрабатывается не больше
+    max_inflight апдейтов: сверх лимита запрос ждёт свободного места, и
+    Telegram сам притормаживает доставку.
+    """
+
+    def __init__(self, dispatcher, secret=WEBHOOK_SECRET, max_inflight=WEBHOOK_MAX_INFLIGHT):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._tasks = set()
+
+    async def handle(self, request):
+        # без секрета не принимаем ничего: иначе любой, кто достучится до порта, пришлёт апдейт от ADMIN_ID
+        if not self.secret or not hmac.compare_digest(
+                request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': bot})
+        except Exception:
+            return web.Response(status=400)
+        
+        await self._inflight.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dispatcher.feed_update(bot, update)
+        except Exception as e:
+            metrics.error('webhook')
+            print(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self._inflight.release()
+
+    async def drain(self):
+        """Дождаться апдейтов, которые уже в обработке"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+async def metrics_endpoint(request):
+    workers = await asyncio.to_thread(metrics.workers) if metrics.shared else ()
+    return web.Response(text=metrics.render_prometheus(workers), content_type='text/plain')
+
+def build_web_app(webhook=None):
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_endpoint)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, webhook.handle)
+    return app
+
+async def start_metrics_server():
+    """/metrics для polling-режима (в webhook-режиме он на том же порту, что и вебхук)"""
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', METRICS_PORT).start()
+    print(f"📈 Метрики: порт {METRICS_PORT}, /metrics")
+    return runner
+
+async def run_webhook(dispatcher=dp):
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ BOT_MODE=webhook без WEBHOOK_URL: задайте WEBHOOK_SECRET, "
+                             "его нужно слать в заголовке X-Telegram-Bot-Api-Secret-Token")
+        # Telegram получит его в set_webhook и пришлёт с каждым апдейтом; новый на каждый запуск
+        secret = secrets.token_urlsafe(32)
+    webhook = WebhookServer(dispatcher, secret)
+    runner = web.AppRunner(build_web_app(webhook))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', WEBHOOK_PORT).start()
+    print(f"🌐 Webhook: порт {WEBHOOK_PORT}, путь {WEBHOOK_PATH}")
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                              secret_token=secret,
+                              allowed_updates=dp.resolve_used_update_types(),
+                              max_connections=min(WEBHOOK_MAX_INFLIGHT, 100))
+    else:
+        print("⚠️ WEBHOOK_URL не задан — webhook в Telegram не регистрируется (локальный режим)")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+    try:
+        await stop.wait()
+    finally:
+        # вебхук не удаляем: пока бот перезапускается, Telegram копит апдейты
+        await runner.cleanup()
+        await webhook.drain()
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+        await bot.session.close()
+
+# ===== НЕСКОЛЬКО ПРОЦЕССОВ =====
+def shard_key(update):
+    """Чей апдейт: пользователь, иначе чат. Апдейты одного ключа всегда попадают в один воркер"""
+    context = UserContextMiddleware.resolve_event_context(update)
+    return context.user_id or context.chat_id or 0
+
+class UpdateFanout(BaseMiddleware):
+    """Приёмник (WORKERS > 1): апдейт не обрабатывается на месте, а уходит воркеру shard_key % N"""
+
+    def __init__(self, inboxes):
+        self.inboxes = inboxes
+
+    async def __call__(self, handler, event, data):
+        inbox = self.inboxes[shard_key(event) % len(self.inboxes)]
+        inbox.put(('update', event.model_dump_json(exclude_unset=True, by_alias=True)))
+
+class KeyedRunner:
+    """Апдейты одного ключа выполняются строго по очереди, разных ключей — параллельно"""
+
+    def __init__(self):
+        self._tails = {}
+
+    def submit(self, key, coro):
+        task = asyncio.create_task(self._after(self._tails.get(key), coro))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._tails.get(key) is t and self._tails.pop(key))
+
+    async def _after(self, previous, coro):
+        if previous:
+            await asyncio.wait([previous])
+        await coro
+
+    async def drain(self):
+        if self._tails:
+            await asyncio.gather(*self._tails.values(), return_exceptions=True)
+
+class CatalogSync:
+    """Изменения каталога между воркерами.
+
+    Воркер, изменивший каталог, публикует событие; приёмник пересылает его
+    остальным воркерам, и те применяют его к своей копии каталога.
+    В однопроцессном режиме publish ничего не делает.
+    """
+
+    def __init__(self):
+        self.events = None
+        self.origin = None
+
+    def attach(self, events, origin):
+        self.events = events
+        self.origin = origin
+
+    def publish(self, kind, payload=None):
+        if self.events is not None:
+            self.events.put((self.origin, kind, payload))
+
+    async def apply(self, kind, payload):
+        if kind == 'add':
+            for row in sorted(await db.fetch_products_by_id(payload)):
+                catalog.add(product_from_row(row))
+        elif kind == 'remove':
+            catalog.remove(*payload)
+        elif kind == 'categories':
+            catalog.set_categories(payload)
+        elif kind == 'photos':
+            catalog.set_photos(payload)
+        elif kind == 'reload':
+            await reload_catalog()
+
+catalog_sync = CatalogSync()
+
+async def process_update(update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        metrics.error('worker')
+        print(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+
+async def worker_main(index, inbox, events, metrics_dir):
     dp.include_router(router)
+    dp.update.outer_middleware(UpdateMetrics())
+    setup()
+    register_gauges()
+    metrics.shared, metrics.worker = metrics_dir, index
+    exporter = asyncio.create_task(export_worker_metrics())
+    catalog_sync.attach(events, index)
+    if index == 0:
+        snapshots.start()  # снимок пишет один воркер, остальные только читают его при старте
+        broadcasts.start()  # рассылки ведёт он же, задания от других воркеров берёт из БД
+    runner = KeyedRunner()
+    loop = asyncio.get_running_loop()
+    print(f"👷 Воркер {index}: pid {os.getpid()}, товаров {len(catalog)}, "
+          f"готов через {time.monotonic() - STARTED_AT:.2f} с (каталог: {startup['source']})")
+    # баннер приёмника ждёт этого события от всех воркеров
+    events.put((index, 'ready', {'products': len(catalog), 'source': startup['source'], 'catalog': startup['catalog']}))
+    try:
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:
+                break
+            kind, payload = message
+            if kind == 'update':
+                update = Update.model_validate_json(payload, context={'bot': bot})
+                runner.submit(shard_key(update), process_update(update))
+            else:
+                await catalog_sync.apply(kind, payload)
+    finally:
+        exporter.cancel()
+        await runner.drain()
+        await shutdown()
+        await bot.session.close()
+
+def run_worker(index, inbox, events, metrics_dir):
+    # останавливает воркеры приёмник (через None в очереди), Ctrl+C ловит только он
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_main(index, inbox, events, metrics_dir))
+
+async def relay_catalog_events(events, inboxes, ready):
+    """Приёмник: событие каталога от одного воркера → всем остальным; 'ready' — воркер запустился"""
+    loop = asyncio.get_running_loop()
+    while True:
+        event = await loop.run_in_executor(None, events.get)
+        if event is None:
+            return
+        origin, kind, payload = event
+        if kind == 'ready':
+            ready(origin, payload)
+            continue
+        for index, inbox in enumerate(inboxes):
+            if index != origin:
+                inbox.put((kind, payload))
+
+async def run_receiver():
+    """WORKERS > 1: этот процесс только принимает апдейты (polling или webhook) и раздаёт их воркерам"""
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(WORKERS)]
+    events = context.Queue()
+    # метрики воркеров: каждый сохраняет свои в эту папку, /metrics приёмника отдаёт их с меткой worker
+    metrics.shared = tempfile.mkdtemp(prefix='poizon-metrics-')
+    workers = [context.Process(target=run_worker, args=(i, inboxes[i], events, metrics.shared), name=f"worker-{i}")
+               for i in range(WORKERS)]
+    for process in workers:
+        process.start()
+    started = {}  # номер воркера → его тайминги старта
+    all_started = asyncio.Event()
+
+    def worker_ready(index, timings):
+        started[index] = timings
+        if len(started) == WORKERS:
+            all_started.set()
+
+    relay = asyncio.create_task(relay_catalog_events(events, inboxes, worker_ready))
+
+    async def wait_for_workers():
+        """Баннер — только когда все воркеры загрузили каталог и готовы отвечать"""
+        while not all_started.is_set():
+            try:
+                await asyncio.wait_for(all_started.wait(), 1)
+            except asyncio.TimeoutError:
+                for process in workers:
+                    if not process.is_alive():
+                        raise SystemExit(f"❌ {process.name} завершился при старте (код {process.exitcode})")
+        # в баннер — самый медленный воркер: пока он грузил каталог, бот не был готов
+        startup.update(max(started.values(), key=lambda timings: timings['catalog']))
+        print_banner()
+    
+    receiver = Dispatcher(disable_fsm=True)
+    receiver.startup.register(wait_for_workers)
+    receiver.update.outer_middleware(UpdateFanout(inboxes))
+    loop = asyncio.get_running_loop()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(receiver)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await receiver.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in workers:
+            await loop.run_in_executor(None, process.join, 30)
+        events.put(None)
+        await relay
+        shutil.rmtree(metrics.shared, ignore_errors=True)
+
+# ===== ЗАПУСК =====
+async def stop_sending():
+    """Дописать пачки постов, остановить рассылку и дослать очередь, пока сессия бота открыта"""
+    await channel_batcher.drain()
+    await forward_batcher.drain()
+    await broadcasts.close()
+    await outbox.stop()
+
+async def shutdown():
+    """Дописать всё накопленное в памяти и закрыть БД"""
+    await stop_sending()
+    await views.close()
+    await storage.close()
+    await snapshots.close()
+    db.close()
+
+def register_gauges():
+    metrics.gauge('poizon_catalog_products', lambda: len(catalog))
+    metrics.gauge('poizon_outbox_queue', lambda: outbox._queue.qsize())
+    metrics.gauge('poizon_throttled_callbacks', lambda: throttle.rejected)
+
+def print_banner():
+    """Баннер печатается, когда диспетчер запущен и бот уже может отвечать"""
+    ready = time.monotonic() - STARTED_AT
+    metrics.gauge('poizon_startup_seconds', lambda: round(ready, 3))
     print("=" * 60)
     print("🤖 POIZON LAB БОТ ЗАПУЩЕН!")
     print(f"📱 Канал: {CHANNEL_ID}")
-    print(f"📦 Товаров в базе: {len(products_db)}")
+    if 'source' in startup:
+        print(f"📦 Товаров в базе: {startup.get('products', len(catalog))}")
     print(f"🔄 Автопарсер: ВКЛ")
     print(f"📥 Парсер старых постов: ВКЛ (пересылайте посты)")
+    print(f"📡 Режим: {BOT_MODE}")
+    if WORKERS > 1:
+        print(f"👷 Воркеров: {WORKERS}")
+    timings = f"БД {startup['db']:.2f} с"
+    if 'source' in startup:
+        timings += f", каталог {startup['catalog']:.2f} с ({startup['source']})"
+    if WORKERS > 1:
+        timings += ", все воркеры готовы"
+    print(f"⏱ Готов отвечать через {ready:.2f} с после старта: {timings}")
     print("=" * 60)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+
+async def main():
+    dp.include_router(router)
+    # при WORKERS > 1 каталог нужен только воркерам, приёмник его не грузит
+    setup(load_catalog=WORKERS == 1)
+    dp.startup.register(print_banner)
+    # start_polling и run_webhook закрывают сессию бота сразу после shutdown-хуков:
+    # всё неотправленное досылается в них, а не в shutdown() после закрытия сессии
+    dp.shutdown.register(stop_sending)
+    dp.update.outer_middleware(UpdateMetrics())
+    if WORKERS == 1:
+        # при WORKERS > 1 снимок и рассылки ведёт воркер 0, а gauge каталога и очередей
+        # отдают воркеры — у приёмника нет каталога
+        register_gauges()
+        snapshots.start()
+        broadcasts.start()
+    metrics_runner = None
+    try:
+        if WORKERS > 1:
+            if METRICS_PORT and BOT_MODE != 'webhook':
+                metrics_runner = await start_metrics_server()
+            await run_receiver()
+        elif BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            if METRICS_PORT:
+                metrics_runner = await start_metrics_server()
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await shutdown()
+
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    # python bot.py import result.json — офлайн-импорт без запуска бота
+    if len(sys.argv) == 3 and sys.argv[1] == 'import':
+        setup(load_catalog=False)
+        try:
+            stats = import_export(sys.argv[2])
+            print(f"✅ Готово: {stats}")
+        finally:
+            db.close()
+    # python bot.py reparse — пересчёт цен по описаниям без запуска бота
+    elif len(sys.argv) == 2 and sys.argv[1] == 'reparse':
+        setup(load_catalog=False)
+        try:
+            checked, changed, seconds = db.write_sync(reparse_prices)
+            print(f"✅ Проверено: {checked}, изменено: {changed}, {checked / max(seconds, 1e-9):.0f} подписей/с")
+        finally:
+            db.close()
+    else:
+        asyncio.run(main())
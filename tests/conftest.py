@@ -0,0 +1,10 @@
+"""Общее для тестов: bot.py импортируется с тестовым токеном — сеть и боевая БД не нужны.
+
+Запуск: python -m pytest -q tests
+"""
+import os
+import sys
+
+os.environ.setdefault('BOT_TOKEN', '123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST')
+os.environ.setdefault('ADMIN_ID', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+"""Ленивое удаление в CatalogIndex: счётчики и страницы совпадают с перебором."""
+import random
+
+import bot
+
+CATEGORIES = ['A', 'B', 'C']
+
+def expected(products, category):
+    return [p for p in products if category == 'all' or p.category == category]
+
+def check(index, products):
+    for category in ['all', *CATEGORIES]:
+        items = expected(products, category)
+        assert index.count(category) == len(items)
+        assert index.page(category, 0, 5) == items[::-1][:5]
+        assert index.page(category, 1, 5) == items[::-1][5:10]
+        priced = [p for p in sorted((p for p in items if p.price is not None), key=bot.price_key) if p.price >= 200]
+        assert index.price_page(category, 'asc', 200, None, 0, 5) == (priced[:5], len(priced))
+        assert index.price_page(category, 'desc', 200, None, 0, 5) == (priced[::-1][:5], len(priced))
+
+def test_bulk_remove_keeps_counts_and_pages():
+    rng = random.Random(1)
+    index = bot.CatalogIndex()
+    products = [bot.Product(pid, f'товар {pid}', rng.choice([None, *range(100, 1000, 50)]), rng.choice(CATEGORIES), None)
+                for pid in range(1, 201)]
+    for product in products:
+        index.add(product)
+    index.by_price()
+    for _ in range(5):
+        # пачка удалений без чтений между ними, потом проверка и новые товары
+        for product in rng.sample(products, 15):
+            assert index.remove(product.id) is product
+            products.remove(product)
+        assert index.remove(10 ** 6) is None
+        check(index, products)
+        fresh = bot.Product(len(products) + 1000 + rng.randrange(10 ** 6), 'новый', 300, rng.choice(CATEGORIES), None)
+        index.add(fresh)
+        products.append(fresh)
+        check(index, products)
+
+def test_readd_after_remove():
+    index = bot.CatalogIndex()
+    old = bot.Product(1, 'старый', 100, 'A', None)
+    index.add(old)
+    index.remove(1)
+    new = bot.Product(1, 'новый', 200, 'B', None)
+    index.add(new)
+    assert index.count('all') == 1 and index.count('A') == 0
+    assert index.page('all') == [new] and index.page('A') == []
+
+def test_set_categories_after_remove():
+    index = bot.CatalogIndex()
+    products = [bot.Product(pid, str(pid), 100 * pid, 'A', None) for pid in range(1, 5)]
+    for product in products:
+        index.add(product)
+    index.remove(2)
+    index.set_categories({3: ('A', 'B')})
+    assert index.count('A') == 2 and index.count('B') == 1
+    assert index.page('A') == [products[3], products[0]]
+    assert index.page('all') == [products[3], products[2], products[0]]
@@ -0,0 +1,19 @@
+"""Приоритет категорий в CategoryClassifier."""
+import bot
+
+def test_priority_wins_when_keywords_overlap():
+    # «кросс» — префикс слова «кроссовки» из другой категории: побеждает порядок priority, а не длина совпадения
+    categories = {'A': ['кросс'], 'B': ['кроссовки']}
+    assert bot.CategoryClassifier(categories, ['A', 'B']).classify('Кроссовки Nike') == 'A'
+    assert bot.CategoryClassifier(categories, ['B', 'A']).classify('Кроссовки Nike') == 'B'
+
+def test_priority_does_not_depend_on_position():
+    categories = {'A': ['худи'], 'B': ['кроссовки']}
+    classifier = bot.CategoryClassifier(categories, ['A', 'B'])
+    assert classifier.classify('Кроссовки и худи в наличии') == 'A'
+    assert classifier.classify('Просто текст') == '🎒 Другое'
+
+def test_catalog_priority():
+    assert bot.detect_category('Худи и кроссовки') == '🧥 Верхняя одежда'
+    assert bot.detect_category('Футболка, кепка') == '👕 Одежда'
+    assert bot.detect_category('Кроссовки + сумка') == '👟 Обувь'
@@ -0,0 +1,41 @@
+"""Запись пачки постов: ошибка в одной строке не теряет остальные, пост из импорта получает фото."""
+import asyncio
+
+import pytest
+
+import bot
+
+def row(post_id, price, photo='photo'):
+    return (f'товар {post_id}', 'описание', price, photo, post_id, '🎒 Другое', None, None)
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bot.setup(load_catalog=False)
+    yield bot.db
+    bot.db.close()
+
+def photos(db):
+    return dict(db.read_sync(lambda conn: conn.execute("SELECT post_id, photo FROM products").fetchall()))
+
+def test_bad_row_keeps_the_batch(db, monkeypatch):
+    price_number = bot.price_number
+
+    def failing(price):
+        if price == '0':
+            raise OverflowError('слишком большое число')
+        return price_number(price)
+
+    monkeypatch.setattr(bot, 'price_number', failing)
+    results = asyncio.run(db.insert_products([row(1, '100'), row(2, '0'), row(3, '300'), row(1, '100')]))
+    assert results == [('added', 1), None, ('added', 2), ('duplicate', None)]
+    assert sorted(photos(db)) == [1, 3]
+
+def test_reingest_fills_photo_of_imported_post(db):
+    db.write_sync(bot.import_batch, 'test', [('товар 1', 'описание', '100', 100, bot.CHANNEL_ID, 1, '🎒 Другое', None),
+                                             ('товар 2', 'описание', '200', 200, bot.CHANNEL_ID, 2, '🎒 Другое', None)], 2)
+    results = asyncio.run(db.insert_products([row(1, '100', 'file-1'), row(2, '200', None)]))
+    assert results == [('photo', 1), ('duplicate', None)]
+    results = asyncio.run(db.insert_products([row(1, '100', 'file-new')]))
+    assert results == [('duplicate', None)]
+    assert photos(db) == {1: 'file-1', 2: None}
@@ -0,0 +1,39 @@
+"""Метрики при WORKERS > 1: файлы воркеров в общей папке, /metrics с меткой worker, сумма для /perf."""
+import bot
+
+def worker_metrics(seconds, errors):
+    metrics = bot.Metrics()
+    for value in seconds:
+        metrics.observe('handler', 'show_catalog', value)
+    for _ in range(errors):
+        metrics.error('outbox')
+    metrics.gauge('poizon_catalog_products', lambda: 500)
+    return metrics
+
+def test_workers_are_exported_with_label(tmp_path):
+    for index, seconds in ((0, [0.001, 0.002]), (1, [0.003])):
+        bot.write_worker_metrics(tmp_path / f'worker-{index}.pickle', worker_metrics(seconds, index).dump())
+    (tmp_path / 'worker-2.pickle').write_bytes(b'')  # файл ещё пишется — пропускается
+    receiver = bot.Metrics()
+    receiver.shared = str(tmp_path)
+    workers = receiver.workers()
+    assert [index for index, _ in workers] == [0, 1]
+    text = receiver.render_prometheus(workers)
+    assert text.count("# TYPE poizon_handler_seconds histogram") == 1
+    assert 'poizon_handler_seconds_count{worker="0",handler="show_catalog"} 2' in text
+    assert 'poizon_handler_seconds_count{worker="1",handler="show_catalog"} 1' in text
+    assert 'poizon_errors_total{worker="1",where="outbox"} 1' in text
+    assert 'poizon_catalog_products{worker="1"} 500' in text
+
+def test_merge_sums_workers(tmp_path):
+    own = worker_metrics([0.001], 1)
+    own.shared, own.worker = str(tmp_path), 0
+    bot.write_worker_metrics(tmp_path / 'worker-0.pickle', worker_metrics([5.0] * 10, 7).dump())
+    bot.write_worker_metrics(tmp_path / 'worker-1.pickle', worker_metrics([0.002, 0.004], 2).dump())
+    total = bot.Metrics()
+    total.merge(own.dump())
+    for _, state in own.workers():  # свой старый файл не читается
+        total.merge(state)
+    histogram = total.histograms['handler']['show_catalog']
+    assert histogram.count == 3 and abs(histogram.sum - 0.007) < 1e-9
+    assert total.error_counts() == {'outbox': 3}
@@ -0,0 +1,38 @@
+"""keyset_page: проход вперёд и назад по страницам совпадает со срезами отсортированного списка."""
+import random
+import sqlite3
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def conn():
+    rng = random.Random(2)
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, kind TEXT, created_at INTEGER)")
+    conn.executemany("INSERT INTO items VALUES (?, ?, ?)",
+                     [(i, rng.choice('ab'), rng.randrange(10)) for i in range(1, 60)])
+    return conn
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_walk_forward_and_back(conn, descending):
+    expected = sorted(conn.execute("SELECT id, created_at FROM items WHERE kind='a'"),
+                      key=lambda row: (row[1], row[0]), reverse=descending)
+    page = lambda cursor, direction: bot.keyset_page(
+        conn, "SELECT id, created_at FROM items", ["kind=?"], ['a'], ('created_at', 'id'),
+        cursor, direction, 7, descending)
+    pages, cursor, has_next = [], None, True
+    while has_next:
+        rows, has_next, first = page(cursor, 'next')
+        assert rows == expected[len(pages) * 7:(len(pages) + 1) * 7] and not first
+        pages.append(rows)
+        cursor = (rows[-1][1], rows[-1][0])
+    for number in range(len(pages) - 1, 0, -1):
+        rows, has_next, first = page((pages[number][0][1], pages[number][0][0]), 'prev')
+        assert (rows, has_next, first) == (pages[number - 1], True, False)
+
+def test_short_prev_page_restarts_from_first(conn):
+    first_page = bot.keyset_page(conn, "SELECT id FROM items", [], [], ('id',), None, 'next', 7)
+    # курсор сбит (например, товары удалены): перед ним меньше страницы — отдаётся первая
+    assert bot.keyset_page(conn, "SELECT id FROM items", [], [], ('id',), (4,), 'prev', 7) == (*first_page[:2], True)
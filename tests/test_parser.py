@@ -0,0 +1,23 @@
+"""Эталон разбора подписей: CaptionParser.parse на корпусе bench/captions.json."""
+import json
+import os
+
+import pytest
+
+import bot
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'captions.json')
+
+with open(CORPUS, encoding='utf-8') as f:
+    CASES = json.load(f)
+
+@pytest.mark.parametrize('case', CASES)
+def test_caption_matches_golden(case):
+    got = dict(zip(('title', 'price', 'currency', 'sizes'), bot.caption_parser.parse(case['text'])))
+    assert got == {key: case[key] for key in got}
+
+def test_label_wins_over_earlier_rubles():
+    # «Цена:» важнее суммы в рублях выше по тексту, а сумма в юанях рядом с «Ценой» — не цена
+    assert bot.caption_parser.price("Было 15 990 ₽\nЦена: 12 990") == (12990, 'RUB')
+    assert bot.caption_parser.price("Цена: 899¥\nУ нас 12 990 ₽") == (12990, 'RUB')
+    assert bot.caption_parser.price("Цена на Poizon: 899¥") == (899, 'CNY')
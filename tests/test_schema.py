@@ -0,0 +1,64 @@
+"""Миграция старой базы: цены текстом из первой версии бота → products.price_value."""
+import sqlite3
+
+import bot
+
+BASELINE = '''
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    price TEXT,
+    photo TEXT,
+    source TEXT,
+    post_id INTEGER UNIQUE,
+    category TEXT DEFAULT '🎒 Другое',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    username TEXT,
+    full_name TEXT,
+    product TEXT,
+    price TEXT,
+    type TEXT,
+    status TEXT DEFAULT 'new',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+# Старый парсер склеивал размеры с ценой через перевод строки
+PRICES = {1: '12990', 2: '36373839404142434445\n12990', 3: 'Цена в ЛС', 4: '7490'}
+
+def baseline_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE)
+    conn.executemany("INSERT INTO products (id, name, price, post_id) VALUES (?, 'товар', ?, ?)",
+                     [(pid, price, pid) for pid, price in PRICES.items()])
+    conn.commit()
+    return conn
+
+def price_values(conn):
+    return dict(conn.execute("SELECT id, price_value FROM products"))
+
+def test_price_number_rejects_implausible_numbers():
+    assert bot.price_number('12990') == 12990
+    assert bot.price_number('36373839404142434445\n12990') is None
+    assert bot.price_number('Цена в ЛС') is None
+    assert bot.stored_price(12345678901234567890, 'RUB') == "Цена в ЛС"
+
+def test_baseline_prices_migrate(tmp_path):
+    conn = baseline_db(tmp_path / 'bot.db')
+    bot.create_schema(conn)
+    conn.commit()
+    assert price_values(conn) == {1: 12990, 2: None, 3: None, 4: 7490}
+
+def test_unfinished_backfill_is_resumed(tmp_path):
+    # Колонка уже добавлена, а пересчёт не дошёл до конца — следующий старт досчитывает
+    conn = baseline_db(tmp_path / 'bot.db')
+    conn.execute("ALTER TABLE products ADD COLUMN price_value INTEGER")
+    conn.commit()
+    bot.create_schema(conn)
+    conn.commit()
+    assert price_values(conn) == {1: 12990, 2: None, 3: None, 4: 7490}